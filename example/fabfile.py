@@ -1,6 +1,7 @@
 import fabdeploit
 from fabric.api import *
 import os
+import random
 
 
 class GitFilter(fabdeploit.GitFilter):
@@ -9,21 +10,10 @@ class GitFilter(fabdeploit.GitFilter):
             name = os.path.basename(obj.path)
             if not name[0] in ('1', '5', 'R'):
                 self.remove(name)
-        with lcd(self.repo.working_tree_dir):
-            local('echo $RANDOM > FOOBAR')
-            self.add('FOOBAR')
-
-            local('mkdir -p a1/b')
-            local('echo $RANDOM > a1/b/1')
-            self.add('a1/b/1')
-
-            local('mkdir -p a2/b')
-            local('echo $RANDOM > a2/b/2')
-            self.add('a2/b/2')
-
-            local('mkdir -p a3/b')
-            local('echo $RANDOM > a3/b/3')
-            self.add('a3/b/3')
+        self.add_bytes('FOOBAR', '%d\n' % random.randint(0, 32767))
+        self.add_bytes('a1/b/1', '%d\n' % random.randint(0, 32767))
+        self.add_bytes('a2/b/2', '%d\n' % random.randint(0, 32767))
+        self.add_bytes('a3/b/3', '%d\n' % random.randint(0, 32767))
 
 
 class Git(fabdeploit.Git):
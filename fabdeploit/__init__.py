@@ -5,9 +5,12 @@ from . import django
 from . import virtualenv
 from . import drupal
 from . import magento
+from . import executor
+from . import manifest
 
 Git = git.Git
 GitFilter = git.GitFilter
+PatternGitFilter = git.PatternGitFilter
 Django = django.Django
 Virtualenv = virtualenv.Virtualenv
 Virtualenv2 = virtualenv.Virtualenv2
@@ -15,3 +18,5 @@ Virtualenv3 = virtualenv.Virtualenv3
 VirtualenvGit = virtualenv.VirtualenvGit
 Drupal = drupal.Drupal
 Magento = magento.Magento
+HostExecutor = executor.HostExecutor
+ReleaseManifest = manifest.ReleaseManifest
@@ -1,11 +1,111 @@
 import fabric.api as fab
-from .utils import select_bin
-from fabric.contrib import files
+from .utils import select_bin, invalidate_select_bin, mutated_paths
+from .facts import get_host_facts, peek_host_facts
+import contextlib
 import posixpath
+import uuid
 import os
 
 
+class BatchedCommand(object):
+    '''Single command queued inside a CommandBatch
+
+    return_code and stdout are filled in when the batch gets executed. Commands
+    never reached (because some earlier command failed) keep return_code None.'''
+
+    def __init__(self, command, warn_only=False):
+        self.command = command
+        self.warn_only = warn_only
+        self.return_code = None
+        self.stdout = None
+
+    @property
+    def executed(self):
+        return self.return_code is not None
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return self.executed and not self.succeeded
+
+    def __str__(self):
+        return self.stdout if self.stdout is not None else ''
+
+
+class CommandBatch(object):
+    '''Queue of commands sent to the host as one shell script
+
+    Every command runs inside its own subshell (including the cd/prefix context
+    it was queued in). After each command a marker line containing the exit code
+    is printed, so the output can be split up again afterwards. Like fab.run()
+    the script stops on the first failing command unless warn_only was set
+    for this command.'''
+
+    def __init__(self, util):
+        self.util = util
+        self.commands = []
+        self.marker = 'FABDEPLOIT-BATCH-%s' % uuid.uuid4().hex
+
+    def add(self, command, warn_only=None, quiet=False, **kwargs):
+        if warn_only is None:
+            warn_only = fab.env.warn_only or quiet
+        batched_command = BatchedCommand(self.util._prefix_command(command), warn_only=warn_only)
+        self.commands.append(batched_command)
+        return batched_command
+
+    def script(self):
+        lines = []
+        for i, batched_command in enumerate(self.commands):
+            lines.append('( %s )' % batched_command.command)
+            lines.append('__fabdeploit_rc=$?')
+            lines.append("printf '\\n%s %d %d\\n' {marker} {index} $__fabdeploit_rc".format(
+                marker=self.marker,
+                index=i,
+            ))
+            if not batched_command.warn_only:
+                lines.append('[ $__fabdeploit_rc -eq 0 ] || exit $__fabdeploit_rc')
+        lines.append('exit 0')
+        return '\n'.join(lines)
+
+    def _parse(self, output):
+        stdout_lines = []
+        for line in output.splitlines():
+            line = line.rstrip('\r')
+            if line.startswith(self.marker + ' '):
+                index, return_code = line[len(self.marker) + 1:].split()
+                batched_command = self.commands[int(index)]
+                batched_command.return_code = int(return_code)
+                # drop the newline printed in front of the marker
+                if stdout_lines and stdout_lines[-1] == '':
+                    stdout_lines.pop()
+                batched_command.stdout = '\n'.join(stdout_lines)
+                stdout_lines = []
+            else:
+                stdout_lines.append(line)
+
+    def execute(self):
+        if not self.commands:
+            return []
+        self._parse(self.util._run_script(self.script()))
+        for batched_command in self.commands:
+            if batched_command.executed:
+                # commands carry their own cd prefix
+                self.util._after_run(batched_command.command, cwd='')
+        for batched_command in self.commands:
+            if batched_command.failed and not batched_command.warn_only:
+                fab.abort('Batched command failed with return code %d while executing %r' % (
+                    batched_command.return_code,
+                    batched_command.command,
+                ))
+        return self.commands
+
+
 class BaseCommandUtil(object):
+    _command_batch = None
+
     def __init__(self, **kwargs):
         for key in kwargs:
             if hasattr(self, key):
@@ -13,24 +113,158 @@ class BaseCommandUtil(object):
             else:
                 raise RuntimeError('Unknown key {key}'.format(key=key))
 
+    def _fact_paths(self):
+        '''Paths this utility works on, checked when gathering the host facts'''
+        return []
+
+    def _fact_commands(self):
+        '''Commands this utility may use, all *_commands options by default'''
+        commands = []
+        for name in dir(self.__class__):
+            if name.endswith('_commands') and not name.startswith('_'):
+                value = getattr(self, name)
+                if isinstance(value, (list, tuple)):
+                    commands.extend(value)
+        return commands
+
+    def _host_facts(self):
+        return get_host_facts(
+            paths=[path for path in self._fact_paths() if path],
+            commands=self._fact_commands(),
+        )
+
     def _pwd(self):
-        try:
-            return self._pwd_path
-        except AttributeError:
-            self._pwd_path = self._run('pwd')
-            return self._pwd_path
+        return self._host_facts().home
 
     def _abs_path(self, path):
         return self._path_join(self._pwd(), path)
 
     def _select_bin(self, *commands, **kwargs):
+        if kwargs.get('remote', True):
+            # first contact gathers all facts, including the default binaries
+            self._host_facts()
         return select_bin(*commands, **kwargs)
 
+    def _invalidate_select_bin(self, *paths):
+        invalidate_select_bin(paths=list(paths) if paths else None, host=fab.env.host_string)
+
+    @contextlib.contextmanager
+    def _batch(self):
+        '''Queue all commands passed to _run() and send them as one script
+
+        _run() returns BatchedCommand instances while the batch is open, their
+        return_code/stdout gets available after the with block. Nested calls
+        reuse the outer batch.'''
+
+        if self._command_batch is not None:
+            yield self._command_batch
+            return
+        batch = self._command_batch = CommandBatch(self)
+        try:
+            yield batch
+        finally:
+            self._command_batch = None
+        batch.execute()
+
     def _run(self, *args, **kwargs):
+        if self._command_batch is not None:
+            return self._command_batch.add(*args, **kwargs)
+        result = self._run_command(*args, **kwargs)
+        self._after_run(args[0] if args else kwargs['command'])
+        return result
+
+    def _run_command(self, *args, **kwargs):
         return fab.run(*args, **kwargs)
 
+    def _run_script(self, script):
+        with fab.settings(warn_only=True, cwd='', command_prefixes=[]):
+            return self._run_command(script)
+
+    def _prefix_command(self, command):
+        from fabric.operations import _prefix_commands
+        return _prefix_commands(command, 'remote')
+
+    def _after_run(self, command, cwd=None):
+        '''Invalidates all cached paths the command may have changed'''
+        facts = peek_host_facts()
+        if facts is None:  # nothing cached yet
+            return
+        if cwd is None:
+            cwd = fab.env.cwd
+        paths = mutated_paths(command, cwd=cwd)
+        if paths is None:  # unable to parse, play safe
+            paths = [cwd or '.']
+        facts.invalidate_paths(*paths)
+
+    def _stat_path(self, path):
+        # relative paths are relative to the current cd(), otherwise to home
+        if fab.env.cwd and not posixpath.isabs(path) and not path.startswith('~'):
+            return posixpath.join(fab.env.cwd, path)
+        return path
+
+    def _stat(self, *paths):
+        '''Returns {path: PathStat}, unknown paths are fetched in one round trip'''
+        stats = self._host_facts().stat(*[self._stat_path(path) for path in paths])
+        return dict([(path, stats[self._stat_path(path)]) for path in paths])
+
+    def _invalidate_paths(self, *paths):
+        facts = peek_host_facts()
+        if facts is not None:
+            facts.invalidate_paths(*[self._stat_path(path) for path in paths])
+
     def _exists(self, path):
-        return files.exists(path)
+        return self._stat(path)[path].exists
+
+    def _is_link(self, path):
+        return self._stat(path)[path].is_link
+
+    def _upload_file(self, local_path, remote_path, resumable=False):
+        '''Uploads a single file, returns the number of bytes sent
+
+        resumable uses rsync, keeping partial uploads and appending to them
+        on the next try (the whole file is verified afterwards).'''
+        sent = os.path.getsize(local_path)
+        if resumable:
+            from fabric.contrib.project import rsync_project as rsync
+            import re
+
+            output = rsync(
+                local_dir=local_path,
+                remote_dir=remote_path,
+                default_opts='-ptz',
+                extra_opts='--partial --append-verify --stats',
+                capture=True,
+            )
+            # "Total bytes sent: 1,234" (newer versions use thousands separators)
+            match = re.search(r'^Total bytes sent: ([0-9,.]+)', output, re.M)
+            if match:
+                sent = int(re.sub('[,.]', '', match.group(1)))
+        else:
+            fab.put(local_path, remote_path)
+        self._invalidate_paths(remote_path)
+        return sent
+
+    def _upload_files(self, local_dir, remote_dir, paths):
+        '''Uploads paths (relative to local_dir) into remote_dir using one rsync call
+
+        Files already existing on the remote are skipped without comparing
+        them, so this is meant for content-addressed (immutable) files.'''
+        from fabric.contrib.project import rsync_project as rsync
+        import tempfile
+
+        if not paths:
+            return
+        with tempfile.NamedTemporaryFile('w', prefix='fabdeploit-files-') as files_from:
+            files_from.write(''.join([path + '\n' for path in paths]))
+            files_from.flush()
+            self._run('mkdir -p "%s"' % remote_dir)
+            rsync(
+                local_dir=local_dir.rstrip(os.sep) + os.sep,
+                remote_dir=remote_dir.rstrip('/') + '/',
+                default_opts='-ptz',
+                extra_opts='--ignore-existing --files-from="%s"' % files_from.name,
+            )
+        self._invalidate_paths(remote_dir)
 
     def _path_join(self, *paths):
         return posixpath.join(*paths)
@@ -42,16 +276,93 @@ class BaseCommandUtil(object):
 
 
 class LocalCommandMixin(object):
+    def _host_facts(self):
+        raise RuntimeError('Host facts are not available for local commands')
+
+    def _pwd(self):
+        return os.getcwd()
+
     def _select_bin(self, *commands, **kwargs):
         kwargs.setdefault('remote', False)
         return super(LocalCommandMixin, self)._select_bin(*commands, **kwargs)
 
-    def _run(self, *args, **kwargs):
+    def _run_command(self, *args, **kwargs):
         fab.local(*args, **kwargs)
 
+    def _run_script(self, script):
+        with fab.settings(warn_only=True, lcwd='', command_prefixes=[]):
+            return fab.local(script, capture=True)
+
+    def _prefix_command(self, command):
+        from fabric.operations import _prefix_commands
+        return _prefix_commands(command, 'local')
+
+    def _after_run(self, command, cwd=None):
+        pass
+
+    def _stat(self, *paths):
+        # no cache needed locally
+        from .facts import PathStat
+
+        stats = {}
+        for path in paths:
+            if os.path.islink(path):
+                path_type = 'link'
+            elif os.path.isdir(path):
+                path_type = 'dir'
+            elif os.path.isfile(path):
+                path_type = 'file'
+            elif os.path.exists(path):
+                path_type = 'other'
+            else:
+                path_type = 'missing'
+            stats[path] = PathStat(
+                path,
+                path_type,
+                os.path.exists(path),
+                os.readlink(path) if path_type == 'link' else None,
+            )
+        return stats
+
+    def _invalidate_paths(self, *paths):
+        pass
+
     def _exists(self, path):
         return os.path.exists(path)
 
+    def _is_link(self, path):
+        return os.path.islink(path)
+
+    def _upload_file(self, local_path, remote_path, resumable=False):
+        # appending to partial copies, like rsync --append does
+        import shutil
+
+        offset = 0
+        if resumable and os.path.exists(remote_path):
+            offset = os.path.getsize(remote_path)
+            if offset > os.path.getsize(local_path):
+                offset = 0
+        with open(local_path, 'rb') as source:
+            with open(remote_path, 'ab' if offset else 'wb') as target:
+                source.seek(offset)
+                shutil.copyfileobj(source, target)
+        return os.path.getsize(local_path) - offset
+
+    def _upload_files(self, local_dir, remote_dir, paths):
+        import shutil
+
+        for path in paths:
+            target_path = os.path.join(remote_dir, path)
+            if os.path.exists(target_path):
+                continue
+            if not os.path.isdir(os.path.dirname(target_path)):
+                os.makedirs(os.path.dirname(target_path))
+            tmp_path = target_path + '.fabdeploit-tmp'
+            if os.path.exists(tmp_path):  # left over by some interrupted copy
+                os.remove(tmp_path)
+            shutil.copy2(os.path.join(local_dir, path), tmp_path)
+            os.rename(tmp_path, target_path)
+
     def _path_join(self, *paths):
         return os.path.join(*paths)
 
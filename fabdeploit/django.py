@@ -14,6 +14,9 @@ class Django(BaseCommandUtil):
         if self.manage_path is None:
             raise RuntimeError('No manage_path specified (class or constructor)')
 
+    def _fact_paths(self):
+        return [self.manage_path]
+
     def run(self, command, *options):
         self._run("%s %s %s %s" % (
             self.virtualenv.python_bin(),
@@ -16,6 +16,9 @@ class Drupal(BaseCommandUtil):
         if self.drush_path is None:
             raise RuntimeError('No drush_path specified (class or constructor)')
 
+    def _fact_paths(self):
+        return [self.drupal_path, self.drush_path, self.php_ini_path]
+
     def php_bin(self):
         return self._select_bin(*self.php_commands)
 
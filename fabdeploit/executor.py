@@ -0,0 +1,153 @@
+from __future__ import absolute_import
+import pickle
+import time
+import traceback
+import fabric.api as fab
+
+
+class HostResult(object):
+    '''Outcome of running something on one host
+
+    result contains the return value (or its repr() if the value could not be
+    passed back from the worker process). error and traceback are set when
+    the host failed, abort() counts as failure, too.'''
+
+    def __init__(self, host, result=None, error=None, traceback=None, started=None, duration=None):
+        self.host = host
+        self.result = result
+        self.error = error
+        self.traceback = traceback
+        self.started = started
+        self.duration = duration
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+    def __repr__(self):
+        return '<HostResult %s %s (%.2fs)>' % (
+            self.host,
+            'succeeded' if self.succeeded else 'failed: %s' % self.error,
+            self.duration or 0,
+        )
+
+
+class ExecutionResult(dict):
+    '''{host: HostResult} for one HostExecutor run'''
+
+    duration = None
+
+    @property
+    def succeeded(self):
+        return dict([(host, result) for host, result in self.items() if result.succeeded])
+
+    @property
+    def failed(self):
+        return dict([(host, result) for host, result in self.items() if result.failed])
+
+    @property
+    def slowest(self):
+        if not self:
+            return None
+        return max(self.values(), key=lambda result: result.duration)
+
+    def raise_for_failures(self):
+        if self.failed:
+            raise RuntimeError('Execution failed on %d host(s): %s' % (
+                len(self.failed),
+                ', '.join(['%s (%s)' % (host, result.error) for host, result in sorted(self.failed.items())]),
+            ))
+        return self
+
+
+def _picklable(value):
+    try:
+        pickle.dumps(value)
+        return value
+    except Exception:
+        return repr(value)
+
+
+def _run_on_host(func, args, kwargs):
+    host = fab.env.host_string
+    started = time.time()
+    try:
+        result = func(*args, **kwargs)
+    except (Exception, SystemExit) as e:  # SystemExit is raised by abort()
+        return HostResult(
+            host,
+            error=repr(e),
+            traceback=traceback.format_exc(),
+            started=started,
+            duration=time.time() - started,
+        )
+    return HostResult(
+        host,
+        result=_picklable(result),
+        started=started,
+        duration=time.time() - started,
+    )
+
+
+class HostExecutor(object):
+    '''Runs utility methods on many hosts at once
+
+    Uses fabric's execute() in parallel mode, so every host is handled in its own
+    worker process (fabric's env is global state, so threads cannot be used here)
+    with its own connection and env. At most pool_size hosts are handled at the
+    same time. Failures do not stop the other hosts, instead all results, errors
+    and timings are collected per host.
+
+    Usage might look like:
+    executor = HostExecutor(hosts=['web1', 'web2', 'web3'], pool_size=10)
+    results = executor.run(git, 'push_release')
+    results.raise_for_failures()
+    executor.run(git, 'switch_release').raise_for_failures()
+
+    Note: Utility instances are copied into the worker processes, changes done
+    inside the workers (like caches) do not get back into the calling process.
+    Return values must be picklable, otherwise only their repr() is returned.
+    '''
+
+    hosts = None
+    pool_size = 10
+    parallel = True
+
+    def __init__(self, **kwargs):
+        for key in kwargs:
+            if hasattr(self, key):
+                setattr(self, key, kwargs[key])
+            else:
+                raise RuntimeError('Unknown key {key}'.format(key=key))
+        if self.hosts is None:
+            self.hosts = list(fab.env.hosts)
+
+    def call(self, func, *args, **kwargs):
+        ''' Runs func(*args, **kwargs) on all hosts, returns ExecutionResult '''
+
+        from fabric.tasks import execute
+
+        started = time.time()
+        with fab.settings(fab.hide('running'), parallel=self.parallel, pool_size=self.pool_size):
+            results = execute(
+                _run_on_host,
+                func,
+                args,
+                kwargs,
+                hosts=self.hosts,
+            )
+        execution_result = ExecutionResult()
+        for host, result in results.items():
+            if not isinstance(result, HostResult):  # worker died before returning
+                result = HostResult(host, error=repr(result))
+            execution_result[host] = result
+        execution_result.duration = time.time() - started
+        return execution_result
+
+    def run(self, util, method_name, *args, **kwargs):
+        ''' Runs util.method_name(*args, **kwargs) on all hosts '''
+        return self.call(getattr(util, method_name), *args, **kwargs)
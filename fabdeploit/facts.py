@@ -0,0 +1,237 @@
+from __future__ import absolute_import
+import posixpath
+import threading
+import fabric.api as fab
+from .utils import DEFAULT_BIN_PATHS, seed_select_bin
+
+
+FACT_MARKER = 'fabdeploit-fact'
+
+
+class PathStat(object):
+    '''State of one remote path
+
+    type is one of "file", "dir", "link", "other" or "missing". exists follows
+    symlinks (like test -e), so a dangling symlink has type "link" but does not
+    exist. link_target is only set for symlinks.'''
+
+    def __init__(self, path, type, exists, link_target=None):
+        self.path = path
+        self.type = type
+        self.exists = exists
+        self.link_target = link_target
+
+    @property
+    def is_link(self):
+        return self.type == 'link'
+
+    @property
+    def is_dir(self):
+        return self.type == 'dir'
+
+    def __repr__(self):
+        return '<PathStat %s %s>' % (self.path, self.type)
+
+
+class HostFacts(object):
+    '''Facts about one host, gathered in a single round trip
+
+    HostFacts instances are shared by all utilities talking to the same host
+    (see get_host_facts()). Paths and commands are collected from the utilities
+    asking for facts, unknown ones will be gathered in one additional round trip
+    when needed. Relative paths are resolved against the home directory, like
+    fabric does for run() without cd().
+
+    Available facts:
+    * home: home directory (login directory)
+    * git_version: tuple like (2, 39, 5), None if git is not available
+    * disk_free: free disk space in the home directory (KiB)
+    * binaries: {command: path} for commands found in DEFAULT_BIN_PATHS
+    * paths: {absolute_path: PathStat}
+
+    The paths double as a stat cache: stat() fills all unknown paths in one
+    round trip, invalidate_paths() needs to be called whenever some path gets
+    changed (BaseCommandUtil does this for all mutating commands it runs).
+    '''
+
+    def __init__(self, host):
+        self.host = host
+        self.home = None
+        self.git_version = None
+        self.disk_free = None
+        self.binaries = {}
+        self.paths = {}
+        self.commands = set()
+        self._lock = threading.RLock()
+
+    def _abs_path(self, path):
+        if path.startswith('~'):
+            path = self.home + path[1:]
+        return posixpath.normpath(posixpath.join(self.home, path))
+
+    def path_exists(self, path):
+        ''' Returns True/False, None if the path is unknown '''
+        try:
+            return self.paths[self._abs_path(path)].exists
+        except KeyError:
+            return None
+
+    def is_link(self, path):
+        ''' Returns True/False, None if the path is unknown '''
+        try:
+            return self.paths[self._abs_path(path)].is_link
+        except KeyError:
+            return None
+
+    @property
+    def symlinks(self):
+        return dict([
+            (path, path_stat.link_target)
+            for path, path_stat in self.paths.items()
+            if path_stat.is_link
+        ])
+
+    def stat(self, *paths):
+        ''' Returns {path: PathStat}, all unknown paths are fetched in one round trip '''
+        self.gather(paths=paths)
+        return dict([(path, self.paths[self._abs_path(path)]) for path in paths])
+
+    def invalidate_paths(self, *paths):
+        '''Forget about paths, their contents and missing parents
+
+        Parents are only dropped if they were known to be missing, as
+        creating some path (mkdir -p, rsync, ...) may create them.'''
+        if self.home is None:
+            return
+        with self._lock:
+            for path in paths:
+                path = self._abs_path(path)
+                for cached_path in list(self.paths.keys()):
+                    if cached_path == path or cached_path.startswith(path.rstrip('/') + '/'):
+                        del self.paths[cached_path]
+                parent = posixpath.dirname(path)
+                while parent in self.paths and not self.paths[parent].exists:
+                    del self.paths[parent]
+                    parent = posixpath.dirname(parent)
+
+    def missing(self, paths=(), commands=()):
+        if self.home is None:
+            return list(paths), list(commands)
+        return (
+            [path for path in paths if self._abs_path(path) not in self.paths],
+            [command for command in commands if command not in self.commands],
+        )
+
+    def _script(self, paths, commands):
+        lines = ['cd >/dev/null 2>&1']
+        if self.home is None:
+            lines.extend([
+                'printf "{marker} home %s\\n" "$(pwd)"'.format(marker=FACT_MARKER),
+                'printf "{marker} git_version %s\\n" "$(git --version 2>/dev/null)"'.format(marker=FACT_MARKER),
+                'printf "{marker} disk_free %s\\n" "$(df -Pk . 2>/dev/null | awk \'NR==2 {{print $4}}\')"'.format(
+                    marker=FACT_MARKER,
+                ),
+            ])
+        for index, command in enumerate(commands):
+            for path in DEFAULT_BIN_PATHS:
+                lines.append('test -e "{bin_path}" && printf "{marker} bin {index} %s\\n" "{bin_path}"'.format(
+                    marker=FACT_MARKER,
+                    bin_path=posixpath.join(path, command),
+                    index=index,
+                ))
+        for index, path in enumerate(paths):
+            lines.append(
+                'p="$(echo {path})"; l=; '
+                'if [ -L "$p" ]; then t=link; l="$(readlink "$p")"; '
+                'elif [ -d "$p" ]; then t=dir; elif [ -f "$p" ]; then t=file; '
+                'elif [ -e "$p" ]; then t=other; else t=missing; fi; '
+                'if [ -e "$p" ]; then e=1; else e=0; fi; '
+                'printf "{marker} path {index} %s %s %s\\n" "$t" "$e" "$l"'.format(
+                    marker=FACT_MARKER,
+                    path=path,
+                    index=index,
+                ))
+        lines.append('true')
+        return '\n'.join(lines)
+
+    def gather(self, paths=(), commands=()):
+        ''' Gathers all missing facts in one round trip '''
+
+        with self._lock:
+            return self._gather(paths, commands)
+
+    def _gather(self, paths, commands):
+        paths, commands = self.missing(paths, commands)
+        if self.home is not None and not paths and not commands:
+            return self
+        with fab.settings(fab.hide('everything'), warn_only=True, cwd='', command_prefixes=[]):
+            output = fab.run(self._script(paths, commands))
+        found_bins = dict([(command, set()) for command in commands])
+        for line in output.splitlines():
+            line = line.strip()
+            if not line.startswith(FACT_MARKER + ' '):
+                continue
+            parts = line[len(FACT_MARKER) + 1:].split(' ', 1)
+            key, value = parts[0], parts[1] if len(parts) > 1 else ''
+            if key == 'home':
+                self.home = value
+            elif key == 'git_version':
+                version = value.split()[-1] if value else None
+                self.git_version = tuple([
+                    int(part) for part in version.split('.') if part.isdigit()
+                ]) if version else None
+            elif key == 'disk_free':
+                self.disk_free = int(value) if value.isdigit() else None
+            elif key == 'bin':
+                index, bin_path = value.split(' ', 1)
+                found_bins[commands[int(index)]].add(bin_path)
+            elif key == 'path':
+                index, path_type, exists, link_target = (value.split(' ', 3) + [''])[:4]
+                path = self._abs_path(paths[int(index)])
+                self.paths[path] = PathStat(
+                    path,
+                    path_type,
+                    exists == '1',
+                    link_target if path_type == 'link' else None,
+                )
+        for command in commands:
+            self.commands.add(command)
+            for path in DEFAULT_BIN_PATHS:
+                bin_path = posixpath.join(path, command)
+                if bin_path in found_bins[command]:
+                    self.binaries.setdefault(command, bin_path)
+                seed_select_bin(self.host, path, command, bin_path in found_bins[command])
+        return self
+
+
+_host_facts = {}
+_host_facts_lock = threading.Lock()
+
+
+def get_host_facts(paths=(), commands=(), host=None):
+    ''' Returns the (shared) HostFacts for the current host, gathers missing facts '''
+
+    if host is None:
+        host = fab.env.host_string
+    with _host_facts_lock:
+        facts = _host_facts.get(host)
+        if facts is None:
+            facts = _host_facts[host] = HostFacts(host)
+    return facts.gather(paths=paths, commands=commands)
+
+
+def peek_host_facts(host=None):
+    ''' Returns the HostFacts for the current host if already available, never gathers '''
+
+    if host is None:
+        host = fab.env.host_string
+    with _host_facts_lock:
+        return _host_facts.get(host)
+
+
+def invalidate_host_facts(host=None):
+    with _host_facts_lock:
+        if host is None:
+            _host_facts.clear()
+        else:
+            _host_facts.pop(host, None)
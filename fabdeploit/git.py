@@ -1,40 +1,205 @@
 from __future__ import absolute_import
 import warnings
 import fabric.api as fab
+import binascii
+import contextlib
 import datetime
 import os
+import posixpath
 from time import time, altzone
 from .base import BaseCommandUtil
 from .utils import legacy_wrap
+from .gittree import TreeBuilder, diff_trees, is_tree_mode, BLOB_MODE
+from .gitobjects import LooseObjectWriter, PackObjectWriter, CHUNK_SIZE
+from .patterns import PathPatterns
+from .manifest import ReleaseManifest
 import git
 
 
+# Namespace for all refs fabdeploit keeps in the local repository
+FABDEPLOIT_REFS = 'refs/fabdeploit'
+# Notes containing the release catalog entries (JSON)
+RELEASE_NOTES_REF = 'refs/notes/fabdeploit'
+# Lists the files offloaded from the release tree, see GitFilter.offload_assets()
+ASSET_MANIFEST_PATH = '.fabdeploit-assets'
+
+
 def _git_raw_write_object(repo, obj):
     from stat import S_ISLNK
+    from io import BytesIO
     from gitdb import IStream
-    try:
-        from cStringIO import StringIO
-    except ImportError:
-        from StringIO import StringIO
 
     if obj.__class__.type == git.Blob.type:
         absfilepath = os.path.join(repo.working_tree_dir, obj.path)
         st = os.lstat(absfilepath)
-        streamlen = st.st_size
         if S_ISLNK(st.st_mode):
-            stream = StringIO(os.readlink(absfilepath))
+            obj.binsha = _git_store_blob(LooseObjectWriter(repo), BytesIO(_readlink(absfilepath)), None)
         else:
-            stream = open(absfilepath, 'rb')
-    else:
-        stream = StringIO()
-        obj._serialize(stream)
-        streamlen = stream.tell()
-        stream.seek(0)
+            with open(absfilepath, 'rb') as stream:
+                obj.binsha = _git_store_blob(LooseObjectWriter(repo), stream, st.st_size)
+        return obj
+
+    stream = BytesIO()
+    obj._serialize(stream)
+    streamlen = stream.tell()
+    stream.seek(0)
     istream = repo.odb.store(IStream(obj.__class__.type, streamlen, stream))
     obj.binsha = istream.binsha
     return obj
 
 
+def _git_index_from_tree(repo, tree):
+    """ Creates an in memory index for tree, never touching the default index """
+    import tempfile
+
+    index = git.IndexFile.new(repo, tree)
+    # Point the index to a path private to this invocation, so it never gets
+    # written to the default index by accident. Nothing gets written there
+    # unless someone calls index.write() explicitly.
+    index_fd, index_path = tempfile.mkstemp(prefix='fabdeploit-index-', dir=repo.git_dir)
+    os.close(index_fd)
+    os.remove(index_path)
+    index._file_path = index_path
+    return index
+
+
+def _git_index_cleanup(index):
+    if index is not None and os.path.exists(index.path):
+        os.remove(index.path)
+
+
+def _readlink(path):
+    target = os.readlink(path)
+    if not isinstance(target, bytes):
+        target = target.encode('utf-8')
+    return target
+
+
+def _git_store_blob(writer, stream, size):
+    """Hashes and stores size bytes read from stream as blob, returns its binsha
+
+    Without size the stream is read into memory first, as git needs to know
+    the size before hashing."""
+    return writer.store(git.Blob.type, stream, size)
+
+
+def _git_hash_file(absfilepath):
+    """ Returns (mode, binsha, size) for a file without storing anything """
+    import hashlib
+    from stat import S_ISLNK
+    from git.index.fun import stat_mode_to_index_mode
+
+    st = os.lstat(absfilepath)
+    mode = stat_mode_to_index_mode(st.st_mode)
+    if S_ISLNK(st.st_mode):
+        data = _readlink(absfilepath)
+        return mode, hashlib.sha1(b'blob ' + str(len(data)).encode('ascii') + b'\0' + data).digest(), len(data)
+    sha = hashlib.sha1(b'blob ' + str(st.st_size).encode('ascii') + b'\0')
+    with open(absfilepath, 'rb') as stream:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return mode, sha.digest(), st.st_size
+
+
+def _git_store_file(writer, absfilepath):
+    """ Stores a file (or symlink) as blob, returns its binsha """
+    from io import BytesIO
+
+    if os.path.islink(absfilepath):
+        return _git_store_blob(writer, BytesIO(_readlink(absfilepath)), None)
+    with open(absfilepath, 'rb') as stream:
+        return _git_store_blob(writer, stream, os.fstat(stream.fileno()).st_size)
+
+
+def _git_object_sizes(repo, binshas):
+    """ Returns {binsha: size} (None for missing objects), using one git call """
+    import binascii
+    import subprocess
+
+    if not binshas:
+        return {}
+    binshas = list(set(binshas))
+    process = subprocess.Popen(
+        ['git', '--git-dir', repo.git_dir, 'cat-file', '--batch-check'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    output, _ = process.communicate(b''.join([binascii.hexlify(binsha) + b'\n' for binsha in binshas]))
+    if process.returncode != 0:
+        raise RuntimeError('Could not check for existing objects (git cat-file failed)')
+    lines = output.splitlines()
+    return dict([
+        (binsha, None if line.endswith(b' missing') else int(line.split()[2]))
+        for binsha, line in zip(binshas, lines)
+    ])
+
+
+def _git_missing_objects(repo, binshas):
+    """ Returns the binshas not available in repo (loose or packed), using one git call """
+    return set([binsha for binsha, size in _git_object_sizes(repo, binshas).items() if size is None])
+
+
+def _git_store_files(repo, writer, absfilepaths, threads=None):
+    """Stores many files as blobs using a thread pool, returns {path: (mode, binsha)}
+
+    Files are hashed first (in parallel), objects already in the repository
+    are not written again. Only the missing objects get compressed and stored
+    (again in parallel). hashlib and zlib release the GIL, so threads scale
+    well here."""
+    from multiprocessing.pool import ThreadPool
+
+    if not absfilepaths:
+        return {}
+    pool = ThreadPool(threads)
+    try:
+        hashed = dict(zip(absfilepaths, pool.map(_git_hash_file, absfilepaths)))
+        missing = _git_missing_objects(repo, [
+            binsha for mode, binsha, size in hashed.values()
+            if not writer.has_object(binsha)
+        ])
+        to_store = [path for path in absfilepaths if hashed[path][1] in missing]
+        # store every object once, even if multiple files have the same content
+        to_store = list(dict([(hashed[path][1], path) for path in to_store]).values())
+        for path, binsha in zip(to_store, pool.map(lambda path: _git_store_file(writer, path), to_store)):
+            if binsha != hashed[path][1]:
+                raise RuntimeError('File changed while adding it to the release (%s)' % path)
+    finally:
+        pool.close()
+        pool.join()
+    return dict([(path, (mode, binsha)) for path, (mode, binsha, size) in hashed.items()])
+
+
+def _git_blob_sha(data):
+    import hashlib
+
+    return hashlib.sha1(b'blob ' + str(len(data)).encode('ascii') + b'\0' + data).digest()
+
+
+def _asset_pointer(key, size):
+    """ Contents of the pointer file replacing an offloaded file """
+    return ('fabdeploit-asset %s %d\n' % (key, size)).encode('ascii')
+
+
+def _parse_asset_manifest(data):
+    """ Returns {path: (key, size)}, lines look like "<key> <size> <path>" """
+    assets = {}
+    for line in data.decode('utf-8').splitlines():
+        if line:
+            key, size, path = line.split(' ', 2)
+            assets[path] = (key, int(size))
+    return assets
+
+
+def _format_asset_manifest(assets):
+    return ''.join([
+        '%s %d %s\n' % (key, size, path)
+        for path, (key, size) in sorted(assets.items())
+    ]).encode('utf-8')
+
+
 def _create_blob_from_file(repo, filepath):
     from git.index.fun import stat_mode_to_index_mode
     from git.util import to_native_path_linux
@@ -50,35 +215,239 @@ def _create_blob_from_file(repo, filepath):
 
 
 class GitFilter(object):
-    def __init__(self, repo, index, base_commit):
+    """ Base class for release filters
+
+    Filters work on an in memory TreeBuilder (see fabdeploit.gittree), all
+    edits (add, remove, rename, set_mode) only change the in memory tree. New
+    trees are written once when the release commit gets created. Blobs added
+    from files get written immediately, using the object writer of the tree
+    builder (loose objects or one pack, see Git.release_pack_objects).
+    """
+
+    # Set to enable the filtered tree cache (see Git.release_filter_cache),
+    # change it whenever the filter produces different results.
+    cache_version = None
+
+    # Set if running the filter on its own output only changes the files
+    # changed in the meantime, needed for Git.release_incremental.
+    idempotent = False
+
+    # Files to replace by pointer files, see offload_assets()
+    asset_patterns = ()
+    asset_min_size = None
+
+    def __init__(self, repo, tree_builder, base_commit):
         self.repo = repo
-        self.index = index
+        self.tree_builder = tree_builder
         self.base_commit = base_commit
+        self._index = None
+
+    @classmethod
+    def cache_identity(cls):
+        """Identifies the filter (and its configuration) for the filtered tree cache
+
+        None disables the cache. Filters depending on configuration should
+        include it here (for example a hash of their settings)."""
+        import hashlib
+
+        if cls.cache_version is None:
+            return None
+        identity = '%s.%s:%s' % (cls.__module__, cls.__name__, cls.cache_version)
+        if cls._offloads_assets():
+            identity += ':assets:%s' % hashlib.sha1(repr((
+                list(cls.asset_patterns) if isinstance(cls.asset_patterns, (list, tuple)) else cls.asset_patterns,
+                cls.asset_min_size,
+            )).encode('utf-8')).hexdigest()
+        return identity
+
+    @classmethod
+    def _offloads_assets(cls):
+        return bool(cls.asset_patterns) or cls.asset_min_size is not None
 
     def filter(self):
         raise NotImplementedError('You should create your own apply() method in your own subclass')
 
     def execute(self):
-        from git.index.util import TemporaryFileSwap
+        # Everything happens in memory, so multiple filters may run in
+        # parallel on the same repository.
+        self.filter()
+        self._sync_index()
+        if self._offloads_assets():
+            self.offload_assets()
+        return self.tree_builder
+
+    def _sync_index(self):
+        # apply changes done using the legacy index (see index property)
+        if self._index is not None:
+            self.tree_builder = TreeBuilder(self.repo, self._index.write_tree(), writer=self.writer)
+            _git_index_cleanup(self._index)
+            self._index = None
 
-        # Move current index out of the way, as we need to work on the default index file
-        index_handler = TemporaryFileSwap(self.index._index_path())
-        try:
-            self.index.write(self.index._index_path())
-            self.filter()
-        finally:
-            del(index_handler)  # release as soon as possible
-        return self.index
+    @property
+    def index(self):
+        warnings.warn(
+            "GitFilter.index is deprecated, use the GitFilter methods to change the tree.",
+            PendingDeprecationWarning)
+        if self._index is None:
+            tree = self.tree_builder.write()
+            self.writer.flush()
+            self._index = _git_index_from_tree(self.repo, tree)
+        return self._index
+
+    @property
+    def writer(self):
+        return self.tree_builder.writer
+
+    def _working_tree_path(self, path):
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.repo.working_tree_dir)
+        return path.replace(os.sep, '/')
 
     def add(self, *paths):
-        self.index.add(paths)
+        """ Adds files (or directories) from the working tree """
+        self._sync_index()
+        for path in paths:
+            path = self._working_tree_path(path)
+            abspath = os.path.join(self.repo.working_tree_dir, path)
+            if os.path.isdir(abspath) and not os.path.islink(abspath):
+                self.add_directory(abspath, path)
+                continue
+            self.add_file(path, abspath)
+
+    def add_directory(self, source_path, target_path='', threads=None):
+        """Adds all files below source_path (may be outside the working tree) to target_path
+
+        Meant for big directories like build output: files are hashed and
+        stored using a pool of threads (default: one per CPU), large files are
+        streamed in chunks and objects already in the repository are skipped.
+        Symlinks are added as symlinks and never followed."""
+        self._sync_index()
+        source_path = os.path.abspath(source_path)
+        absfilepaths = []
+        for dirpath, dirnames, filenames in os.walk(source_path):
+            # symlinks to directories show up as directories, but are not walked
+            filenames = filenames + [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]
+            absfilepaths.extend([os.path.join(dirpath, name) for name in filenames])
+        blobs = _git_store_files(self.repo, self.writer, absfilepaths, threads=threads)
+        for absfilepath in absfilepaths:
+            mode, binsha = blobs[absfilepath]
+            path = os.path.relpath(absfilepath, source_path).replace(os.sep, '/')
+            if target_path.strip('/'):
+                path = target_path.strip('/') + '/' + path
+            self.tree_builder.set(path, mode, binsha)
+
+    def add_bytes(self, path, data, mode=BLOB_MODE):
+        """ Adds data (bytes, text gets encoded as UTF-8) as file path """
+        from io import BytesIO
+
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.add_stream(path, BytesIO(data), len(data), mode=mode)
+
+    def add_stream(self, path, stream, size=None, mode=BLOB_MODE):
+        """Adds the contents of some file-like object as file path
+
+        Without size the stream is read into memory first, as git needs to
+        know the size before hashing. With size given exactly size bytes are
+        read in chunks."""
+        self._sync_index()
+        binsha = _git_store_blob(self.writer, stream, size)
+        self.tree_builder.set(path, mode, binsha)
+
+    def add_file(self, path, filepath, mode=None):
+        """Adds filepath (may be outside the working tree) as file path
+
+        The mode is taken from the file (executable bit, symlink) unless
+        given."""
+        from git.index.fun import stat_mode_to_index_mode
+
+        self._sync_index()
+        if mode is None:
+            mode = stat_mode_to_index_mode(os.lstat(filepath).st_mode)
+        self.tree_builder.set(path, mode, _git_store_file(self.writer, filepath))
 
     def remove(self, *paths):
-        self.index.remove(
-            paths,
-            working_tree=False,  # just to be sure
-            r=True,
-        )
+        """ Removes files or whole directories """
+        self._sync_index()
+        for path in paths:
+            if not self.tree_builder.remove(path):
+                raise RuntimeError('Path does not exist in release tree (%s)' % path)
+
+    def rename(self, old_path, new_path):
+        """ Moves some file or directory to new_path """
+        self._sync_index()
+        try:
+            self.tree_builder.rename(old_path, new_path)
+        except KeyError:
+            raise RuntimeError('Path does not exist in release tree (%s)' % old_path)
+
+    def set_mode(self, path, mode):
+        """ Changes the file mode, use gittree.BLOB_MODE or gittree.EXECUTABLE_MODE """
+        self._sync_index()
+        try:
+            self.tree_builder.set_mode(path, mode)
+        except KeyError:
+            raise RuntimeError('Path does not exist in release tree (%s)' % path)
+
+    def exists(self, path):
+        self._sync_index()
+        return self.tree_builder.exists(path)
+
+    def entries(self, path='', recursive=False):
+        """ Yields (path, mode, binsha) below path, without writing anything """
+        self._sync_index()
+        return self.tree_builder.iter_entries(path, recursive=recursive)
+
+    def offload_assets(self, patterns=None, min_size=None):
+        """Replaces big files by small pointer files, returns {path: (key, size)}
+
+        Files matching patterns (gitignore-style, default: asset_patterns) or
+        having at least min_size bytes (default: asset_min_size) are replaced.
+        The key is the sha of the original blob, all offloaded files are listed
+        in ASSET_MANIFEST_PATH. Git.push_release() uploads their contents into
+        a content-addressed store on the remote, switching hardlinks them into
+        the checkout, see Git.remote_assets_path. Only regular files are
+        offloaded (no executables or symlinks). Runs automatically after
+        filter() if asset_patterns or asset_min_size is set."""
+        self._sync_index()
+        patterns = PathPatterns(self.asset_patterns if patterns is None else patterns)
+        if min_size is None:
+            min_size = self.asset_min_size
+        # sizes are read from the repository, so everything needs to be written
+        self.writer.flush()
+
+        previous = {}
+        manifest_entry = self.tree_builder.get(ASSET_MANIFEST_PATH)
+        if manifest_entry is not None:
+            previous = _parse_asset_manifest(self.repo.odb.stream(manifest_entry[1]).read())
+        assets = {}
+        candidates = {}  # {path: (binsha, matches patterns)}
+        for path, mode, binsha in self.tree_builder.iter_entries(recursive=True):
+            if mode != BLOB_MODE or path == ASSET_MANIFEST_PATH or '\n' in path:
+                continue
+            asset = previous.get(path)
+            if asset is not None and binsha == _git_blob_sha(_asset_pointer(*asset)):
+                assets[path] = asset  # offloaded before (incremental releases)
+                continue
+            matches = patterns.excluded_file(path) if patterns else False
+            if matches or min_size is not None:
+                candidates[path] = (binsha, matches)
+
+        sizes = _git_object_sizes(self.repo, [binsha for binsha, matches in candidates.values()])
+        for path, (binsha, matches) in sorted(candidates.items()):
+            size = sizes[binsha]
+            if size is None:
+                raise RuntimeError('Object missing for %s' % path)
+            if matches or size >= min_size:
+                key = binascii.hexlify(binsha).decode('ascii')
+                self.add_bytes(path, _asset_pointer(key, size))
+                assets[path] = (key, size)
+
+        if assets:
+            self.add_bytes(ASSET_MANIFEST_PATH, _format_asset_manifest(assets))
+        elif manifest_entry is not None:
+            self.tree_builder.remove(ASSET_MANIFEST_PATH)
+        return assets
 
     @property
     def original_tree(self):
@@ -86,37 +455,133 @@ class GitFilter(object):
 
     @property
     def filtered_tree(self):
-        # Will store tree state to disk, be sure when to call this!
-        return self.index.write_tree()
+        # Writes all changed trees (and flushes the pack when writing packs),
+        # prefer entries() when iterating often.
+        self._sync_index()
+        tree = self.tree_builder.write()
+        self.writer.flush()
+        return tree
 
     @filtered_tree.setter
     def filtered_tree(self, new_tree):
         warnings.warn("Setting the tree directly may cause unexpected results.")
-        # Note: GitFilter moves the index to the default index location for all
-        #       available methods (like remove) to work as expected. If you change
-        #       the tree we will switch over to a temporary index. So these methods
-        #       will then fail to work. THIS IS THE EXPECTED RESULT.
         assert new_tree.binsha
-        self.index = git.IndexFile.from_tree(self.repo, new_tree)
+        self._sync_index()
+        self.tree_builder = TreeBuilder(self.repo, new_tree, writer=self.writer)
 
     def _copy_tree(self, original, additions=None, excludes=None):
-        warnings.warn("You don't need to copy trees any more, as fabdeploit switched to using git.IndexFile. Will just return original tree.", PendingDeprecationWarning)
+        warnings.warn("You don't need to copy trees any more, as fabdeploit switched to editing trees in memory. Will just return original tree.", PendingDeprecationWarning)
         if additions or excludes:
             raise RuntimeError('Not possible any more, see warning. Use GitFilter.add/remove instead.')
         return original
 
 
+class PatternGitFilter(GitFilter):
+    """Removes paths using gitignore-style patterns
+
+    patterns is a list of patterns (or a string containing one pattern per
+    line), exactly like a .gitignore file: the last matching pattern wins,
+    "!" includes paths again. The tree is walked once, excluded directories
+    are removed as a whole without looking at their contents (so like in git,
+    files inside excluded directories cannot be included again).
+
+    Subclasses may set patterns as class attribute or override get_patterns() to
+    build them dynamically. Override filter() and call super() to add files.
+
+    Usage might look like:
+    class ReleaseFilter(PatternGitFilter):
+        patterns = [
+            'node_modules/',
+            '/tests/',
+            '*.psd',
+            '/docs/*',
+            '!/docs/public/',
+        ]
+    """
+
+    patterns = ()
+
+    def get_patterns(self):
+        return self.patterns
+
+    @classmethod
+    def cache_identity(cls):
+        import hashlib
+
+        identity = super(PatternGitFilter, cls).cache_identity()
+        if identity is None or cls.get_patterns != PatternGitFilter.get_patterns:
+            return identity
+        patterns = cls.patterns
+        if isinstance(patterns, (list, tuple)):
+            patterns = '\n'.join(patterns)
+        return '%s:%s' % (identity, hashlib.sha1(patterns.encode('utf-8')).hexdigest())
+
+    def filter(self):
+        self.apply_patterns(self.get_patterns())
+
+    def apply_patterns(self, patterns):
+        """ Removes all paths excluded by patterns, returns the removed paths """
+        patterns = PathPatterns(patterns)
+        removed = []
+        if not patterns:
+            return removed
+        pending = ['']
+        while pending:
+            # entries() of a single level is a snapshot, so removing is safe
+            for path, mode, binsha in list(self.entries(pending.pop())):
+                is_dir = is_tree_mode(mode)
+                if patterns.excluded(path, is_dir):
+                    self.tree_builder.remove(path)
+                    removed.append(path)
+                elif is_dir:
+                    pending.append(path)
+        return removed
+
+
+# Work done once per process, see Git.release_memoize
+_pulled_repositories = set()
+_release_commits = {}
+
+
 class Git(BaseCommandUtil):
     local_repository_path = None
     remote_repository_path = None
     release_author = None
     release_branch = None
     release_commit_filter_class = None
+    release_memoize = True
+    release_update_attempts = 5
+    release_incremental = False
+    release_pack_objects = False
+    release_filter_cache = True
+    release_push_transport = 'git'
+    release_upload_attempts = 3
+    release_switch_mode = 'checkout'
+    release_layout = 'checkout'
+    remote_releases_path = None
+    remote_current_path = None
+    release_keep_worktrees = 5
+    remote_sparse_checkout = None
+    release_keep = None
+    remote_repack_threads = 1
+    remote_repack_window_memory = '64m'
+    release_catalog = True
+    release_track_changes = True
+    release_pull_mode = 'checkout'
+    remote_shared_objects_path = None
+    remote_assets_path = None
 
     def __init__(self, **kwargs):
         super(Git, self).__init__(**kwargs)
         self.base_commit = None
         self.release_commit = None
+        self.release_commit_reused = False
+        self.release_tree_builder = None
+        self.release_pack_path = None
+        self.release_tree_cached = False
+        self.release_push_stats = None
+        self.release_switch_stats = None
+        self.release_manifest = None
         if self.local_repository_path is None:
             raise RuntimeError('No local_repository_path specified (class or constructor)')
         if self.remote_repository_path is None:
@@ -125,6 +590,12 @@ class Git(BaseCommandUtil):
             raise RuntimeError('No release_branch specified (class or constructor)')
         self.local_repository_path = os.path.realpath(os.path.abspath(self.local_repository_path))
 
+    def _fact_paths(self):
+        return [
+            self.remote_repository_path,
+            self._path_join(self.remote_repository_path, '.git'),
+        ]
+
     def _get_local_repo(self):
         try:
             return self._local_repo
@@ -173,11 +644,25 @@ class Git(BaseCommandUtil):
     def _raw_write_object(self, obj):
         return _git_raw_write_object(self._get_local_repo(), obj)
 
-    def _raw_update_branch(self, branch_name, commit):
+    def _raw_update_branch(self, branch_name, commit, expected_commit=False):
+        """ Updates branch to point to commit
+
+        If expected_commit is passed the update is only done when the branch still
+        points to this commit (None meaning the branch must not exist). Returns False
+        if the branch changed in the meantime. git update-ref locks the ref, so
+        this is safe for multiple processes working on the same repository.
+        """
         repo = self._get_local_repo()
-        if not branch_name in repo.heads:
-            repo.create_head(branch_name)
-        repo.heads[branch_name].commit = commit
+        args = ['refs/heads/%s' % branch_name, commit.hexsha]
+        if expected_commit is not False:
+            args.append(expected_commit.hexsha if expected_commit is not None else '0' * 40)
+        try:
+            repo.git.update_ref(*args)
+        except git.GitCommandError:
+            if expected_commit is False:
+                raise
+            return False
+        return True
 
     def release_deployment_branch(self):
         return 'release/{release_branch}'.format(release_branch=self.release_branch)
@@ -194,6 +679,11 @@ class Git(BaseCommandUtil):
         if not 'origin' in [_i.name for _i in repo.remotes]:
             raise RuntimeError('No origin exists in remotes')
 
+        if self.release_pull_mode == 'fetch':
+            return self._pull_origin_fetch()
+        if self.release_pull_mode != 'checkout':
+            raise RuntimeError('Unknown release_pull_mode {mode}'.format(mode=self.release_pull_mode))
+
         with fab.lcd(self.local_repository_path):
             fab.local('git fetch origin')  # Make sure we fetch all changes
             fab.local('git checkout "{branch}"'.format(branch=self.release_branch))
@@ -201,11 +691,53 @@ class Git(BaseCommandUtil):
             if ('origin' in [_i.name for _i in repo.remotes] and
                      release_deployment_branch in repo.remotes.origin.refs):
                 # We just update our local release branch to the remote version, no questions asked
-                self._raw_update_branch(release_deployment_branch, repo.remotes.origin.refs[release_deployment_branch])
+                # (unless we compacted the release history and origin has the old one)
+                remote_commit = repo.remotes.origin.refs[release_deployment_branch].commit
+                if not self._is_compacted_from(remote_commit):
+                    self._raw_update_branch(release_deployment_branch, remote_commit)
+
+    def _pull_origin_fetch(self):
+        """Fetches the release branches and moves the local refs, never touching working tree or index
+
+        release_branch is fast-forwarded to origin (kept if it contains local
+        commits, diverged branches raise a RuntimeError as there is no working
+        tree to merge in). The release deployment branch is set to the origin
+        version, like pull_origin() does (unless it is a compacted version of
+        it). Refs are only updated if they did not change in the meantime."""
+        repo = self._get_local_repo()
+        branches = [self.release_branch, self.release_deployment_branch()]
+        refspecs = ['+refs/heads/{branch}:refs/remotes/origin/{branch}'.format(branch=branch) for branch in branches]
+        try:
+            repo.git.fetch('origin', *refspecs)
+        except git.GitCommandError:
+            # the release deployment branch does not exist on origin before the first release
+            repo.git.fetch('origin', refspecs[0])
+            branches = branches[:1]
+
+        for branch in branches:
+            remote_commit = repo.commit('refs/remotes/origin/%s' % branch)
+            local_commit = repo.heads[branch].commit if branch in repo.heads else None
+            if local_commit == remote_commit:
+                continue
+            if branch != self.release_branch and self._is_compacted_from(remote_commit):
+                continue  # compacted history not pushed yet
+            if local_commit is not None and branch == self.release_branch:
+                if repo.is_ancestor(remote_commit, local_commit):
+                    continue  # local commits not pushed yet
+                if not repo.is_ancestor(local_commit, remote_commit):
+                    raise RuntimeError('{branch} has diverged from origin, merge it first'.format(branch=branch))
+            if not self._raw_update_branch(branch, remote_commit, expected_commit=local_commit):
+                raise RuntimeError('{branch} was changed by someone else while pulling'.format(branch=branch))
 
     def pull(self):
+        pull_key = (self.local_repository_path, self.release_branch)
+        if self.release_memoize and pull_key in _pulled_repositories:
+            return
         if 'origin' in [_i.name for _i in self._get_local_repo().remotes]:
             self.pull_origin()
+        # only remembered once the pull succeeded, failed pulls are retried
+        if self.release_memoize:
+            _pulled_repositories.add(pull_key)
 
     def _get_release_actor(self, actor=None):
         if actor is None:
@@ -233,6 +765,25 @@ class Git(BaseCommandUtil):
             parent = repo.heads[release_deployment_branch].commit
         parents = [parent] if parent else []
 
+        # reuse the release commit if we already created it in this process
+        # (for example when running the same task for multiple hosts)
+        memoize_key = (
+            self.local_repository_path,
+            self.release_branch,
+            commit.hexsha,
+            self.__class__,
+            self.release_commit_filter_class,
+            message,
+        )
+        if self.release_memoize and memoize_key in _release_commits:
+            release_commit = _release_commits[memoize_key]
+            if parent is not None and parent.binsha == release_commit.binsha:
+                self.release_commit = release_commit
+                self.release_commit_reused = True
+                return self.release_commit
+        self.release_commit_reused = False
+        self.release_pack_path = None
+
         # create new commit
         if message is None:
             message = (
@@ -243,20 +794,202 @@ class Git(BaseCommandUtil):
                     deployment_branch=release_deployment_branch,
                     timestamp=datetime.datetime.now().isoformat()))
 
-        self.release_commit_index = git.IndexFile.from_tree(repo, self.base_commit.tree)
-        self.filter_release_commit()
+        writer = self._release_object_writer()
+        try:
+            release_tree = self._build_release_tree(parent, writer)
+
+            # write commit and update release branch, other processes may do
+            # the same in parallel, so we only update the branch if it did not
+            # change. If it did we either reuse the release created by the other
+            # process (same tree) or retry using the new parent.
+            for attempt in range(self.release_update_attempts):
+                self.release_commit = self._write_release_commit(writer, release_tree, message, parents)
+                if self._raw_update_branch(release_deployment_branch, self.release_commit, expected_commit=parent):
+                    break
+                parent = repo.commit('refs/heads/%s' % release_deployment_branch)
+                parents = [parent]
+                if parent.tree.binsha == release_tree.binsha:
+                    self.release_commit = parent
+                    self.release_commit_reused = True
+                    break
+            else:
+                raise RuntimeError('Could not update %s, changed by someone else while creating the release' % (
+                    release_deployment_branch,
+                ))
+        finally:
+            writer.close()
+        _release_commits[memoize_key] = self.release_commit
+        # remember the base of this release (and the filter used), see _incremental_release_tree_builder()
+        repo.git.update_ref(self._release_base_ref(self.release_commit), self.base_commit.hexsha)
+        filter_identity = self._release_filter_identity()
+        if filter_identity is not None:
+            from io import BytesIO
+
+            data = filter_identity.encode('utf-8')
+            identity_binsha = _git_store_blob(LooseObjectWriter(repo), BytesIO(data), len(data))
+            repo.git.update_ref(
+                self._release_filter_ref(self.release_commit),
+                binascii.hexlify(identity_binsha).decode('ascii'),
+            )
+        cache_ref = self._filter_cache_ref()
+        if cache_ref is not None and not self.release_tree_cached:
+            repo.git.update_ref(cache_ref, release_tree.hexsha)
+        if self.release_catalog and not self.release_commit_reused:
+            self._record_release(self.release_commit, self.base_commit)
 
-        # write commit
-        self.release_commit = self.release_commit_index.commit(
-            message=message,
-            parent_commits=parents,
-            head=False,
+        return self.release_commit
+
+    def _release_base_ref(self, release_commit):
+        return '{refs}/release-bases/{sha}'.format(refs=FABDEPLOIT_REFS, sha=release_commit.hexsha)
+
+    def _release_filter_ref(self, release_commit):
+        return '{refs}/release-filters/{sha}'.format(refs=FABDEPLOIT_REFS, sha=release_commit.hexsha)
+
+    def _release_filter_identity(self):
+        """Identifies the filter for incremental releases, None if it may not run on its own output
+
+        Only filters declaring themselves idempotent and defining their
+        cache_identity() qualify, Git subclasses overriding
+        filter_release_commit() never do."""
+        filter_class = self.release_commit_filter_class
+        if (
+            filter_class is None or
+            not filter_class.idempotent or
+            self.__class__.filter_release_commit != Git.filter_release_commit
+        ):
+            return None
+        return filter_class.cache_identity()
+
+    def _get_release_filter_identity(self, release_commit):
+        """ Returns the filter identity release_commit was created with, None if unknown """
+        try:
+            return self._get_local_repo().git.cat_file('blob', self._release_filter_ref(release_commit))
+        except git.GitCommandError:
+            return None
+
+    def _get_release_base(self, release_commit):
+        """ Returns the base commit release_commit was created from, None if unknown """
+        try:
+            return self._get_local_repo().commit(self._release_base_ref(release_commit))
+        except (git.BadName, ValueError):
+            return None
+
+    def _has_release_filter(self):
+        return (
+            self.release_commit_filter_class is not None or
+            self.__class__.filter_release_commit != Git.filter_release_commit
+        )
+
+    def _release_object_writer(self):
+        if self.release_pack_objects:
+            return PackObjectWriter(self._get_local_repo())
+        return LooseObjectWriter(self._get_local_repo())
+
+    def _write_release_commit(self, writer, tree, message, parents):
+        """ Writes the release commit using writer, makes all written objects available """
+        if not self.release_pack_objects:
+            return git.Commit.create_from_tree(
+                self._get_local_repo(),
+                tree,
+                message,
+                parent_commits=parents,
+                head=False,
+                author=self._get_release_actor(),
+                committer=self._get_release_actor())
+        from io import BytesIO
+        from time import localtime, timezone
+
+        repo = self._get_local_repo()
+        unix_time = int(time())
+        offset = altzone if localtime().tm_isdst else timezone
+        commit = git.Commit(
+            repo,
+            git.Commit.NULL_BIN_SHA,
+            tree=tree,
             author=self._get_release_actor(),
-            committer=self._get_release_actor())
-        # update release branch
-        self._raw_update_branch(release_deployment_branch, self.release_commit)
+            authored_date=unix_time,
+            author_tz_offset=offset,
+            committer=self._get_release_actor(),
+            committed_date=unix_time,
+            committer_tz_offset=offset,
+            message=message,
+            parents=parents,
+            encoding=git.Commit.default_encoding,
+        )
+        stream = BytesIO()
+        commit._serialize(stream)
+        commit.binsha = writer.store(git.Commit.type, BytesIO(stream.getvalue()), stream.tell())
+        pack_path = writer.flush()
+        if pack_path is not None:
+            self.release_pack_path = pack_path
+        return commit
+
+    def _filter_cache_ref(self):
+        """Returns the ref caching the filtered tree for the current base, None if not cacheable
+
+        Only filters defining their cache_identity() can be cached, Git
+        subclasses overriding filter_release_commit() never are."""
+        import hashlib
+
+        if (
+            not self.release_filter_cache or
+            self.release_commit_filter_class is None or
+            self.__class__.filter_release_commit != Git.filter_release_commit
+        ):
+            return None
+        identity = self.release_commit_filter_class.cache_identity()
+        if identity is None:
+            return None
+        key = hashlib.sha1(('%s\0%s' % (self.base_commit.tree.hexsha, identity)).encode('utf-8')).hexdigest()
+        return '{refs}/filter-cache/{key}'.format(refs=FABDEPLOIT_REFS, key=key)
+
+    def _get_cached_release_tree(self):
+        cache_ref = self._filter_cache_ref()
+        if cache_ref is None:
+            return None
+        try:
+            return self._get_local_repo().tree(cache_ref)
+        except (git.BadName, ValueError):
+            return None
 
-        return self.release_commit
+    def _build_release_tree(self, parent, writer=None):
+        repo = self._get_local_repo()
+        self.release_tree_builder = None
+        cached_tree = self._get_cached_release_tree()
+        self.release_tree_cached = cached_tree is not None
+        if cached_tree is not None:
+            # filter already ran for this base tree, skip it
+            self.release_tree_builder = TreeBuilder(repo, cached_tree, writer=writer)
+            return cached_tree
+        if self.release_incremental and parent is not None:
+            self.release_tree_builder = self._incremental_release_tree_builder(parent, writer)
+        if self.release_tree_builder is None:
+            if not self._has_release_filter():
+                return self.base_commit.tree
+            self.release_tree_builder = TreeBuilder(repo, self.base_commit.tree, writer=writer)
+        self.filter_release_commit()
+        return self.release_tree_builder.write()
+
+    def _incremental_release_tree_builder(self, parent, writer=None):
+        """Patches the tree of the previous release with the changes since its base
+
+        Returns None (meaning: build the full tree) unless the previous release
+        was created by the same idempotent filter (see _release_filter_identity()),
+        as the filter runs again on the already filtered tree."""
+        repo = self._get_local_repo()
+        filter_identity = self._release_filter_identity()
+        if filter_identity is None or self._get_release_filter_identity(parent) != filter_identity:
+            return None
+        previous_base = self._get_release_base(parent)
+        if previous_base is None:
+            return None
+        builder = TreeBuilder(repo, parent.tree, writer=writer)
+        for status, path, mode, binsha in diff_trees(repo, previous_base.tree, self.base_commit.tree):
+            if status == 'D':
+                builder.remove(path)  # may already be removed by the filter
+            else:
+                builder.set(path, mode, binsha)
+        return builder
 
     def filter_release_commit(self):
         # You may write a filter to change the commit after if is initially
@@ -265,16 +998,24 @@ class Git(BaseCommandUtil):
         # I think this only should be used for tree filters, as other data may be
         # set before even creating the commit.
         if self.release_commit_filter_class is not None:
-            self.release_commit_index = self.release_commit_filter_class(
+            self.release_tree_builder = self.release_commit_filter_class(
                 self._get_local_repo(),
-                self.release_commit_index,
+                self.release_tree_builder,
                 self.base_commit,
             ).execute()
 
     def tag_release(self, tag_name):
         if self.release_commit is None:
             raise RuntimeError('You should create a release commit first')
-        self._get_local_repo().create_tag(tag_name, ref=self.release_commit.hexsha1)
+        repo = self._get_local_repo()
+        try:
+            repo.create_tag(tag_name, ref=self.release_commit.hexsha)
+        except git.GitCommandError:
+            # may already exist when the release commit was reused
+            if not (tag_name in repo.tags and repo.tags[tag_name].commit == self.release_commit):
+                raise
+        if self.release_catalog:
+            self._update_release_info(self.release_commit, lambda info: info.update(tag=tag_name))
 
     def merge_release_back(self):
         # We reuse the original commit here, as the release commit may be
@@ -290,22 +1031,357 @@ class Git(BaseCommandUtil):
 
     def release(self, message=None, tag_name=None, merge_back=False):
         self.create_release_commit(message=message)
+        if self.release_keep and not self.release_commit_reused:
+            # squash only once the history doubled, so release shas stay stable most of the time
+            self.compact_release_history(min_length=2 * self.release_keep)
         if tag_name:
             self.tag_release(tag_name)
-        if merge_back:
+        if merge_back and not self.release_commit_reused:
             self.merge_release_back()
         return self.release_commit
 
+    def _copy_release_commit(self, commit, parents, tree=None, message=None):
+        """ Writes a copy of commit with new parents (keeping authors and dates) """
+        new_commit = git.Commit(
+            self._get_local_repo(),
+            git.Commit.NULL_BIN_SHA,
+            tree=tree if tree is not None else commit.tree,
+            author=commit.author,
+            authored_date=commit.authored_date,
+            author_tz_offset=commit.author_tz_offset,
+            committer=commit.committer,
+            committed_date=commit.committed_date,
+            committer_tz_offset=commit.committer_tz_offset,
+            message=message if message is not None else commit.message,
+            parents=parents,
+            encoding=commit.encoding,
+        )
+        return self._raw_write_object(new_commit)
+
+    def compact_release_history(self, keep=None, min_length=None):
+        """Keeps the last keep releases (default: release_keep), squashes all older ones
+
+        The older releases are replaced by a single root commit containing the
+        tree of the newest dropped release, the kept releases are rewritten on
+        top of it (same trees, messages, authors and dates, but new shas). Does
+        nothing if the history is not longer than min_length (default: keep).
+        Returns {old hexsha: new hexsha} for the kept releases, None if nothing
+        was done.
+
+        As the release history gets rewritten push_release() forces the
+        update of the release branch on the remotes. Tags of dropped releases
+        keep their objects alive."""
+        if keep is None:
+            keep = self.release_keep
+        if not keep or keep < 1:
+            raise RuntimeError('Number of releases to keep must be at least 1')
+        if min_length is None:
+            min_length = keep
+        repo = self._get_local_repo()
+        release_deployment_branch = self.release_deployment_branch()
+        if release_deployment_branch not in repo.heads:
+            return None
+        head = repo.heads[release_deployment_branch].commit
+        chain = list(repo.iter_commits(head, first_parent=True, max_count=max(keep, min_length) + 1))
+        if len(chain) <= min_length:
+            return None
+        kept = chain[:keep]
+        squashed = chain[keep]
+
+        root = self._copy_release_commit(
+            squashed,
+            [],
+            message='Squashed release history up to {commit}\n\n{message}'.format(
+                commit=squashed.hexsha,
+                message=squashed.message,
+            ),
+        )
+        mapping = {}
+        parent = root
+        for commit in reversed(kept):
+            parent = self._copy_release_commit(commit, [parent])
+            mapping[commit.hexsha] = parent
+        if not self._raw_update_branch(release_deployment_branch, parent, expected_commit=head):
+            raise RuntimeError('Could not update %s, changed by someone else while compacting' % (
+                release_deployment_branch,
+            ))
+        # until push_origin() succeeds origin still has the old history, see _is_compacted_from()
+        self._write_compaction_marker(head, parent)
+
+        # move release bases and filters to the new shas, drop those of squashed releases
+        for ref_func, namespace in ((self._release_base_ref, 'release-bases'), (self._release_filter_ref, 'release-filters')):
+            for ref in repo.git.for_each_ref('--format=%(refname)', '%s/%s' % (FABDEPLOIT_REFS, namespace)).split():
+                old_hexsha = ref.rsplit('/', 1)[-1]
+                if old_hexsha in mapping:
+                    repo.git.update_ref(ref_func(mapping[old_hexsha]), ref)
+                repo.git.update_ref('-d', ref)
+        if self.release_catalog:
+            self._remap_catalog(mapping)
+        # later hosts of this process must reuse the rewritten release, not create another one
+        for memoize_key, release_commit in list(_release_commits.items()):
+            if release_commit.hexsha in mapping:
+                _release_commits[memoize_key] = mapping[release_commit.hexsha]
+            else:
+                del _release_commits[memoize_key]
+        if self.release_commit is not None and self.release_commit.hexsha in mapping:
+            self.release_commit = mapping[self.release_commit.hexsha]
+        return dict([(old_hexsha, commit.hexsha) for old_hexsha, commit in mapping.items()])
+
+    def _compaction_marker_ref(self):
+        return '{refs}/compacted/{branch}'.format(refs=FABDEPLOIT_REFS, branch=self.release_deployment_branch())
+
+    def _write_compaction_marker(self, old_head, new_head):
+        # a blob containing the shas, a ref to the commits would keep the old history alive
+        from io import BytesIO
+
+        repo = self._get_local_repo()
+        data = ('%s %s\n' % (old_head.hexsha, new_head.hexsha)).encode('ascii')
+        binsha = _git_store_blob(LooseObjectWriter(repo), BytesIO(data), len(data))
+        repo.git.update_ref(self._compaction_marker_ref(), binascii.hexlify(binsha).decode('ascii'))
+
+    def _is_compacted_from(self, remote_commit):
+        """True if the local release branch is a compacted version of remote_commit
+
+        This is the case after compact_release_history() as long as the
+        compacted history was not pushed to origin, pulling must not revert
+        the compaction then."""
+        repo = self._get_local_repo()
+        release_deployment_branch = self.release_deployment_branch()
+        try:
+            old_hexsha, new_hexsha = repo.git.cat_file('blob', self._compaction_marker_ref()).split()
+        except (git.GitCommandError, ValueError):
+            return False
+        if release_deployment_branch not in repo.heads:
+            return False
+        try:
+            return (
+                repo.is_ancestor(new_hexsha, repo.heads[release_deployment_branch].commit.hexsha) and
+                repo.is_ancestor(remote_commit.hexsha, old_hexsha)
+            )
+        except git.GitCommandError:  # old history not available any more
+            return False
+
+    def _remap_catalog(self, mapping):
+        """Moves catalog entries of rewritten releases, drops those of squashed releases
+
+        live/previous refs keep the old shas, as this is what the hosts run."""
+        repo = self._get_local_repo()
+        with self._catalog_lock():
+            for old_hexsha, commit in mapping.items():
+                try:
+                    self._write_release_notes('copy', '-f', old_hexsha, commit.hexsha)
+                except git.GitCommandError:  # no note
+                    pass
+            refs = repo.git.for_each_ref('--format=%(objectname) %(refname)', '%s/releases' % FABDEPLOIT_REFS)
+            for line in refs.splitlines():
+                hexsha, ref = line.split(' ', 1)
+                if hexsha in mapping:
+                    repo.git.update_ref(ref, mapping[hexsha].hexsha, hexsha)
+                else:
+                    repo.git.update_ref('-d', ref, hexsha)
+
+    def compact_remote_repository(self):
+        """Expires reflogs, repacks and prunes the remote repository
+
+        Repacking is bounded (remote_repack_threads, remote_repack_window_memory)
+        and runs with low priority, objects younger than one hour are never
+        pruned, so concurrent pushes are safe. Returns the reclaimed space in
+        bytes."""
+        script = (
+            'cd "{git_dir}" || exit 1\n'
+            'before="$(du -sk . | cut -f1)"\n'
+            'git reflog expire --expire=now --all || exit 1\n'
+            'nice -n 19 git -c pack.threads={threads} -c pack.windowMemory={window_memory} '
+            'repack -a -d -l -q || exit 1\n'
+            'git prune --expire=1.hour.ago || exit 1\n'
+            'after="$(du -sk . | cut -f1)"\n'
+            'echo "fabdeploit-du $before $after"'
+        ).format(
+            git_dir=self._release_git_dir(),
+            threads=int(self.remote_repack_threads),
+            window_memory=self.remote_repack_window_memory,
+        )
+        output = self._run_script(script)
+        if output.failed:
+            fab.abort('Compacting the remote repository failed: %s' % output)
+        reclaimed = None
+        for line in str(output).splitlines():
+            if line.startswith('fabdeploit-du '):
+                before, after = [int(value) for value in line.split()[1:3]]
+                reclaimed = (before - after) * 1024
+                fab.puts('Compacted remote repository from {before} KiB to {after} KiB'.format(
+                    before=before,
+                    after=after,
+                ))
+        return reclaimed
+
+    # Release catalog, see release_catalog
+
+    def _catalog_ref(self, kind, name):
+        import re
+
+        return '{refs}/{kind}/{name}'.format(
+            refs=FABDEPLOIT_REFS,
+            kind=kind,
+            name=re.sub('[^A-Za-z0-9._-]', '_', name),
+        )
+
+    def _catalog_commit(self, ref):
+        try:
+            return self._get_local_repo().commit(ref)
+        except (git.BadName, ValueError):
+            return None
+
+    @contextlib.contextmanager
+    def _catalog_lock(self):
+        # notes are updated read-modify-write, parallel processes need to wait
+        import fcntl
+
+        lock_path = os.path.join(self._get_local_repo().git_dir, 'fabdeploit', 'catalog.lock')
+        if not os.path.isdir(os.path.dirname(lock_path)):
+            try:
+                os.makedirs(os.path.dirname(lock_path))
+            except OSError:  # created by another process
+                pass
+        with open(lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def release_info(self, release=None):
+        """Returns the catalog entry of release (default: the current release commit)
+
+        A dict like {"base": sha, "created": timestamp, "tag": name,
+        "hosts": {host: timestamp of the last switch}}, None if unknown."""
+        import json
+
+        release = self._release_sha(release)
+        try:
+            return json.loads(self._get_local_repo().git.notes('--ref', RELEASE_NOTES_REF, 'show', release))
+        except (git.GitCommandError, ValueError):
+            return None
+
+    def _write_release_notes(self, *args):
+        # notes are commits, use the release actor (build machines might have no user.email)
+        actor = self._get_release_actor()
+        repo = self._get_local_repo()
+        with repo.git.custom_environment(
+                GIT_AUTHOR_NAME=actor.name,
+                GIT_AUTHOR_EMAIL=actor.email,
+                GIT_COMMITTER_NAME=actor.name,
+                GIT_COMMITTER_EMAIL=actor.email):
+            return repo.git.notes('--ref', RELEASE_NOTES_REF, *args)
+
+    def _update_release_info(self, release, update):
+        import json
+
+        with self._catalog_lock():
+            info = self.release_info(release) or {}
+            update(info)
+            self._write_release_notes(
+                'add', '-f',
+                '-m', json.dumps(info, sort_keys=True),
+                release.hexsha,
+            )
+
+    def _record_release(self, release, base):
+        def update(info):
+            info.update(base=base.hexsha, created=int(time()))
+            info.setdefault('hosts', {})
+
+        self._update_release_info(release, update)
+        self._get_local_repo().git.update_ref(self._catalog_ref('releases', base.hexsha), release.hexsha)
+
+    def _record_switch(self, commit=None):
+        try:
+            release = self._get_local_repo().commit(self._release_sha(commit))
+        except (git.BadName, ValueError):  # release unknown to the local repository
+            return
+        host = fab.env.host_string
+        repo = self._get_local_repo()
+
+        def update(info):
+            info.setdefault('hosts', {})[host] = int(time())
+
+        self._update_release_info(release, update)
+        with self._catalog_lock():
+            live = self._catalog_commit(self._catalog_ref('live', host))
+            if live is not None and live != release:
+                repo.git.update_ref(self._catalog_ref('previous', host), live.hexsha)
+            repo.git.update_ref(self._catalog_ref('live', host), release.hexsha)
+
+    def previous_release(self, release=None):
+        """ Returns the release created before release (default: the current release commit) """
+        release = self._get_local_repo().commit(self._release_sha(release))
+        return release.parents[0] if release.parents else None
+
+    def release_for_base(self, base):
+        """ Returns the (latest) release created from the base commit, None if there is none """
+        if isinstance(base, git.Commit):
+            base = base.hexsha
+        else:
+            base = self._get_local_repo().commit(base).hexsha
+        return self._catalog_commit(self._catalog_ref('releases', base))
+
+    def live_release(self, host=None):
+        """ Returns the release last switched to on host (default: current host), None if unknown """
+        return self._catalog_commit(self._catalog_ref('live', host or fab.env.host_string))
+
+    def rollback_target(self, host=None):
+        """ Returns the release host (default: current host) ran before its live release """
+        return self._catalog_commit(self._catalog_ref('previous', host or fab.env.host_string))
+
     def remote_deployment_repository_url(self):
-        if self.remote_repository_path[0] == '/':
-            return 'ssh://%s@%s:%s%s' % (fab.env.user, fab.env.host, fab.env.port, self.remote_repository_path)
+        return self._remote_url(self.remote_repository_path)
+
+    def _remote_url(self, path):
+        if path[0] == '/':
+            return 'ssh://%s@%s:%s%s' % (fab.env.user, fab.env.host, fab.env.port, path)
         else:
-            return 'ssh://%s@%s:%s/~%s/%s' % (fab.env.user, fab.env.host, fab.env.port, fab.env.user, self.remote_repository_path)
+            return 'ssh://%s@%s:%s/~%s/%s' % (fab.env.user, fab.env.host, fab.env.port, fab.env.user, path)
 
     def push_release(self, bare=False):
-        """ Pushes the release branch """
+        """ Pushes the release branch (and prepares its worktree when using the worktree layout) """
+        self._push_release(bare=bare)
+        self.push_release_assets()
+        if self.release_layout == 'worktree':
+            self.prepare_release()
+        elif not bare:
+            self.apply_sparse_checkout()
+
+    def _push_release(self, bare=False):
         # thanks to https://github.com/dbravender/gitric/blob/master/gitric/api.py
 
+        self.release_push_stats = None
+        if self.release_push_transport not in ('git', 'pack', 'bundle'):
+            raise RuntimeError('Unknown release_push_transport {transport}'.format(
+                transport=self.release_push_transport,
+            ))
+        if self.remote_shared_objects_path is not None:
+            # objects go into the shared store, the site only gets the branch
+            site_git_dir = self._remote_git_dir(bare=bare)
+            site_ref = 'refs/heads/%s' % self.release_deployment_branch()
+            old_site_sha = self._remote_ref_sha(site_git_dir, site_ref)
+            if self.release_push_transport == 'git':
+                self._init_remote_repository(bare=bare)
+                self._push_release_git(
+                    self._remote_url(self.remote_shared_objects_path),
+                    'refs/heads/{branch}:{ref}'.format(
+                        branch=self.release_deployment_branch(),
+                        ref=self._shared_release_ref(),
+                    ),
+                )
+            else:
+                self._push_release_file(bare=bare)
+            self._update_remote_ref(
+                site_git_dir,
+                site_ref,
+                old_site_sha,
+                self._get_local_repo().heads[self.release_deployment_branch()].commit.hexsha,
+            )
+            return
+        if self.release_push_transport != 'git':
+            return self._push_release_file(bare=bare)
+
         # init repo and config
         repo = self._get_local_repo()
         release_deployment_branch = self.release_deployment_branch()
@@ -321,24 +1397,277 @@ class Git(BaseCommandUtil):
                 repo.delete_remote(release_remote_name)
                 remote = repo.create_remote(release_remote_name, release_remote_url)
 
-        # initialize the remote repository (idempotent)
+        self._init_remote_repository(bare=bare)
+
+        # push to remote
+        self._push_release_git(release_remote_name, release_deployment_branch)
+        #remote.push(release_deployment_branch)
+
+    def _push_release_git(self, remote, refspec):
+        with fab.lcd(self.local_repository_path):
+            # forced, as compact_release_history() rewrites the release history
+            fab.local('git push "{remote}" "+{refspec}"'.format(
+                remote=remote,
+                refspec=refspec,
+            ))
+
+    def _init_remote_repository(self, bare=False):
+        """ Initializes the remote repository (and the shared object store) (idempotent) """
         if bare:
-            fab.run('git init --bare "%s"' % self.remote_repository_path)
+            self._run('git init --bare "%s"' % self.remote_repository_path)
         else:
-            fab.run('git init "%s"' % self.remote_repository_path)
+            self._run('git init "%s"' % self.remote_repository_path)
             # silence git complaints about pushes coming in on the current branch
             # the pushes only seed the immutable object store and do not modify the
             # working copy
-            fab.run('GIT_DIR="%s/.git" git config receive.denyCurrentBranch ignore' %
+            self._run('GIT_DIR="%s/.git" git config receive.denyCurrentBranch ignore' %
                     self.remote_repository_path)
-
-        # push to remote
-        with fab.lcd(self.local_repository_path):
-            fab.local('git push "{remote}" "{branch}"'.format(
-                remote=release_remote_name,
-                branch=release_deployment_branch,
+        if self.remote_shared_objects_path is not None:
+            self._run('git init --bare "%s"' % self.remote_shared_objects_path)
+            # the refs only keep the latest release of every site, the sites also use
+            # older releases (previous, worktrees, rollbacks), so nothing may be pruned
+            self._run('GIT_DIR="{git_dir}" git config gc.auto 0 && '
+                      'GIT_DIR="{git_dir}" git config gc.pruneExpire never'.format(
+                          git_dir=self.remote_shared_objects_path,
+                      ))
+            # alternates need absolute paths (or paths relative to the objects dir)
+            objects_path = self._abs_path(self._path_join(self.remote_shared_objects_path, 'objects'))
+            alternates_path = self._path_join(self._remote_git_dir(bare=bare), 'objects', 'info', 'alternates')
+            self._run('grep -qxF "{objects}" "{alternates}" 2>/dev/null || echo "{objects}" >> "{alternates}"'.format(
+                objects=objects_path,
+                alternates=alternates_path,
             ))
-        #remote.push(release_deployment_branch)
+
+    def _remote_git_dir(self, bare=False):
+        if bare:
+            return self.remote_repository_path
+        return self._path_join(self.remote_repository_path, '.git')
+
+    def _shared_release_ref(self):
+        """The ref keeping the release of this site alive inside the shared object store
+
+        Every site gets its own ref, older releases still used by the site are
+        only kept as the shared store is never pruned."""
+        import re
+
+        return '{refs}/sites/{site}/{branch}'.format(
+            refs=FABDEPLOIT_REFS,
+            site=re.sub('[^A-Za-z0-9._-]', '_', self.remote_repository_path.strip('/')),
+            branch=self.release_deployment_branch(),
+        )
+
+    def _remote_release_state(self, bare=False):
+        """Initializes the remote repository and returns its release state in one round trip
+
+        Returns (git_dir, ref, old_sha, have_shas), the objects are pushed into
+        git_dir, ref gets updated afterwards (if it still points to old_sha).
+        have_shas are the remote commits known to the local repository, everything
+        reachable from them does not need to be transferred. When using a shared
+        object store this includes the releases of all other sites."""
+        import re
+
+        if self.remote_shared_objects_path is not None:
+            git_dir, ref = self.remote_shared_objects_path, self._shared_release_ref()
+            command = 'GIT_DIR="%s" git for-each-ref --format="%%(objectname) %%(refname)" "%s/sites/"' % (
+                git_dir,
+                FABDEPLOIT_REFS,
+            )
+        else:
+            git_dir, ref = self._remote_git_dir(bare=bare), 'refs/heads/%s' % self.release_deployment_branch()
+            command = 'GIT_DIR="%s" git rev-parse --verify -q "%s" | sed "s|$| %s|"' % (git_dir, ref, ref)
+        with self._batch():
+            self._init_remote_repository(bare=bare)
+            remote_refs = self._run(command, warn_only=True)
+        old_sha, remote_shas = None, []
+        for line in str(remote_refs).splitlines():
+            match = re.match('^([0-9a-f]{40}) (.+)$', line.strip())
+            if match is None:
+                continue
+            remote_shas.append(match.group(1))
+            if match.group(2) == ref:
+                old_sha = match.group(1)
+        missing = _git_missing_objects(self._get_local_repo(), [binascii.unhexlify(sha) for sha in remote_shas])
+        have_shas = sorted(set([sha for sha in remote_shas if binascii.unhexlify(sha) not in missing]))
+        return git_dir, ref, old_sha, have_shas
+
+    def _update_remote_release(self, git_dir, ref, apply_command, remote_path, old_sha, new_sha):
+        """ Applies the uploaded file and moves the release ref, if nobody else did """
+        with self._batch():
+            self._run(apply_command)
+            self._run('rm -f "%s"' % remote_path)
+            self._update_remote_ref(git_dir, ref, old_sha, new_sha)
+
+    def _remote_ref_sha(self, git_dir, ref):
+        """ Returns the sha ref points to on the remote, None if it does not exist (yet) """
+        import re
+
+        with fab.settings(fab.hide('warnings'), warn_only=True):
+            output = self._run('GIT_DIR="%s" git rev-parse --verify -q "%s" 2>/dev/null' % (git_dir, ref))
+        match = re.match('^([0-9a-f]{40})$', str(output).strip())
+        return match.group(1) if match else None
+
+    def _update_remote_ref(self, git_dir, ref, old_sha, new_sha):
+        # the null sha makes sure the ref is only created if it still does not exist
+        self._run('GIT_DIR="%s" git update-ref "%s" %s %s' % (
+            git_dir,
+            ref,
+            new_sha,
+            old_sha if old_sha is not None else '0' * 40,
+        ))
+
+    def _upload_release_file(self, local_path, remote_path, resumable=False):
+        """ Uploads local_path, retrying (and resuming if possible) on failures """
+        started = time()
+        for attempt in range(1, self.release_upload_attempts + 1):
+            try:
+                sent = self._upload_file(local_path, remote_path, resumable=resumable)
+                break
+            except (Exception, SystemExit) as e:  # SystemExit is raised by abort()
+                if attempt == self.release_upload_attempts:
+                    raise
+                fab.puts('Upload of %s failed (%s), retrying' % (os.path.basename(local_path), e))
+        self.release_push_stats = {
+            'transport': self.release_push_transport,
+            'bytes': sent,  # by the successful attempt, resumed uploads only send the remainder
+            'duration': time() - started,
+            'attempts': attempt,
+        }
+        fab.puts('Uploaded {bytes} bytes in {duration:.2f}s ({attempts} attempt(s))'.format(
+            **self.release_push_stats
+        ))
+
+    def _push_release_file(self, bare=False):
+        if self.release_push_transport == 'pack':
+            return self._push_release_pack(bare=bare)
+        return self._push_release_bundle(bare=bare)
+
+    def _push_release_pack(self, bare=False):
+        """Pushes the release branch by uploading a prebuilt pack
+
+        The pack contains all objects between the releases the remote has and
+        the new release. It is built once and cached in the local repository,
+        so all hosts at the same release get the same pack. Thin packs are used,
+        the remote completes them using index-pack --fix-thin."""
+        new_sha = self._get_local_repo().heads[self.release_deployment_branch()].commit.hexsha
+        git_dir, ref, old_sha, have_shas = self._remote_release_state(bare=bare)
+        if old_sha == new_sha:
+            return
+        if new_sha in have_shas:
+            # already pushed for another site sharing the object store, nothing to transfer
+            self._update_remote_ref(git_dir, ref, old_sha, new_sha)
+            return
+        pack_path = self._release_pack(have_shas, new_sha)
+        remote_pack_path = self._path_join(git_dir, 'fabdeploit-push-%s.pack' % new_sha)
+        self._upload_release_file(pack_path, remote_pack_path)
+        self._update_remote_release(
+            git_dir,
+            ref,
+            'GIT_DIR="%s" git index-pack --stdin --fix-thin < "%s"' % (git_dir, remote_pack_path),
+            remote_pack_path,
+            old_sha,
+            new_sha,
+        )
+
+    def _push_release_bundle(self, bare=False):
+        """Pushes the release branch by uploading an incremental git bundle
+
+        The upload is resumable (rsync --partial --append-verify), the remote
+        file name only depends on the releases involved, so even a new run
+        continues an interrupted upload. The bundle gets verified on the
+        remote before anything is changed."""
+        new_sha = self._get_local_repo().heads[self.release_deployment_branch()].commit.hexsha
+        git_dir, ref, old_sha, have_shas = self._remote_release_state(bare=bare)
+        if old_sha == new_sha:
+            return
+        if new_sha in have_shas:
+            # already pushed for another site sharing the object store, nothing to transfer
+            self._update_remote_ref(git_dir, ref, old_sha, new_sha)
+            return
+        bundle_path = self._release_bundle(have_shas, new_sha)
+        remote_bundle_path = self._path_join(git_dir, 'fabdeploit-push-%s' % os.path.basename(bundle_path))
+        self._upload_release_file(bundle_path, remote_bundle_path, resumable=True)
+        self._update_remote_release(
+            git_dir,
+            ref,
+            'GIT_DIR="{git_dir}" git bundle verify "{path}" && GIT_DIR="{git_dir}" git bundle unbundle "{path}"'.format(
+                git_dir=git_dir,
+                path=remote_bundle_path,
+            ),
+            remote_bundle_path,
+            old_sha,
+            new_sha,
+        )
+
+    def _cached_release_file(self, extension, have_shas, new_sha, command, stdin=None):
+        """Returns the path of a file containing everything from have_shas to new_sha
+
+        The file is created by running the git command (writing to stdout) and
+        cached in .git/fabdeploit/transfer, a lock makes sure parallel processes
+        build each file only once. Only files for the latest release are kept."""
+        import fcntl
+        import hashlib
+        import subprocess
+        import tempfile
+
+        repo = self._get_local_repo()
+        cache_dir = os.path.join(repo.git_dir, 'fabdeploit', 'transfer')
+        if not have_shas:
+            base = 'root'
+        elif len(have_shas) == 1:
+            base = have_shas[0]
+        else:  # keep file names short, many sites may share one object store
+            base = 'multi-' + hashlib.sha1(' '.join(sorted(have_shas)).encode('ascii')).hexdigest()
+        path = os.path.join(cache_dir, '%s..%s.%s' % (base, new_sha, extension))
+        if os.path.exists(path):
+            return path
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # created by another process
+                pass
+        with open(os.path.join(cache_dir, 'lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                return path
+            for name in os.listdir(cache_dir):
+                if name != 'lock' and not name.startswith('tmp_') and ('..%s.' % new_sha) not in name:
+                    os.remove(os.path.join(cache_dir, name))
+            tmp_fd, tmp_path = tempfile.mkstemp(prefix='tmp_', dir=cache_dir)
+            try:
+                with os.fdopen(tmp_fd, 'wb') as tmp_file:
+                    process = subprocess.Popen(
+                        ['git', '--git-dir', repo.git_dir] + command,
+                        stdin=subprocess.PIPE,
+                        stdout=tmp_file,
+                    )
+                    process.communicate(stdin.encode('ascii') if stdin else None)
+                if process.returncode != 0:
+                    raise RuntimeError('Could not create %s (git %s failed)' % (os.path.basename(path), command[0]))
+                os.rename(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return path
+
+    def _release_pack(self, have_shas, new_sha):
+        """ Returns the path of a (thin) pack containing everything from have_shas to new_sha """
+        return self._cached_release_file(
+            'pack',
+            have_shas,
+            new_sha,
+            ['pack-objects', '--stdout', '--revs', '--thin', '-q'],
+            stdin=new_sha + '\n' + ''.join(['^%s\n' % sha for sha in have_shas]),
+        )
+
+    def _release_bundle(self, have_shas, new_sha):
+        """ Returns the path of a bundle containing the release branch from have_shas to new_sha """
+        return self._cached_release_file(
+            'bundle',
+            have_shas,
+            new_sha,
+            ['bundle', 'create', '-', 'refs/heads/%s' % self.release_deployment_branch()] +
+            ['^%s' % sha for sha in have_shas],
+        )
 
     def webserver_harden_remote_git(self):
         dotgit_path = self._path_join(self.remote_repository_path, '.git')
@@ -355,14 +1684,15 @@ class Git(BaseCommandUtil):
 
     def _webserver_harden_remote_git_htaccess(self, dotgit_path):
         htaccess_path = self._path_join(dotgit_path, '.htaccess')
-        self._run('echo "<IfVersion < 2.4>" > "%s"' % htaccess_path)
-        self._run('echo "  Satisfy all" >> "%s"' % htaccess_path)
-        self._run('echo "  Order deny,allow" >> "%s"' % htaccess_path)
-        self._run('echo "  Deny from all" >> "%s"' % htaccess_path)
-        self._run('echo "</IfVersion>" >> "%s"' % htaccess_path)
-        self._run('echo "<IfVersion >= 2.4>" >> "%s"' % htaccess_path)
-        self._run('echo "  Require all denied" >> "%s"' % htaccess_path)
-        self._run('echo "</IfVersion>" >> "%s"' % htaccess_path)
+        with self._batch():
+            self._run('echo "<IfVersion < 2.4>" > "%s"' % htaccess_path)
+            self._run('echo "  Satisfy all" >> "%s"' % htaccess_path)
+            self._run('echo "  Order deny,allow" >> "%s"' % htaccess_path)
+            self._run('echo "  Deny from all" >> "%s"' % htaccess_path)
+            self._run('echo "</IfVersion>" >> "%s"' % htaccess_path)
+            self._run('echo "<IfVersion >= 2.4>" >> "%s"' % htaccess_path)
+            self._run('echo "  Require all denied" >> "%s"' % htaccess_path)
+            self._run('echo "</IfVersion>" >> "%s"' % htaccess_path)
 
     def push_origin(self):
         # init repo and config
@@ -371,9 +1701,22 @@ class Git(BaseCommandUtil):
         # push changes
         if not 'origin' in [_i.name for _i in repo.remotes]:
             return
+        release_deployment_branch = self.release_deployment_branch()
+        # compact_release_history() rewrites the release history, so the push
+        # is forced, but only if origin still is at the version we know
+        expected = ''
+        if release_deployment_branch in repo.remotes.origin.refs:
+            expected = repo.remotes.origin.refs[release_deployment_branch].commit.hexsha
         with fab.lcd(self.local_repository_path):
             fab.local('git push origin "{branch}"'.format(branch=self.release_branch))
-            fab.local('git push origin "{branch}"'.format(branch=self.release_deployment_branch()))
+            fab.local('git push --force-with-lease="{branch}:{expected}" origin "{branch}"'.format(
+                branch=release_deployment_branch,
+                expected=expected,
+            ))
+        try:
+            repo.git.update_ref('-d', self._compaction_marker_ref())
+        except git.GitCommandError:  # no marker
+            pass
 
     def push(self):
         if 'origin' in [_i.name for _i in self._get_local_repo().remotes]:
@@ -381,6 +1724,53 @@ class Git(BaseCommandUtil):
         self.push_release()
 
     def switch_release(self, commit=None, update_to_remote=None):
+        track_changes = self.release_track_changes and not update_to_remote
+        if track_changes:
+            old_sha = self._live_release_sha()
+        result = self._switch_release(commit=commit, update_to_remote=update_to_remote)
+        if track_changes:
+            self.release_manifest = self._release_manifest(old_sha, commit)
+        if self.remote_assets_path is not None and self.release_layout == 'checkout':
+            self.materialize_assets()
+        if self.release_catalog and not update_to_remote:
+            self._record_switch(commit)
+        return result
+
+    def _live_release_sha(self):
+        """Returns the sha currently checked out on the remote
+
+        None if there is none yet or the commit is unknown to the local repository."""
+        import re
+
+        if self.release_layout == 'worktree':
+            target = self._link_target(self._current_path())
+            sha = posixpath.basename(target.rstrip('/')) if target else ''
+        else:
+            with fab.hide('warnings'):  # fails before the first switch
+                output = self._run_script('cd "%s" && git rev-parse --verify -q HEAD' % self.remote_repository_path)
+            sha = str(output).strip().split('\n')[-1].strip() if output.succeeded else ''
+        if not re.match('^[0-9a-f]{40}$', sha):
+            return None
+        if _git_missing_objects(self._get_local_repo(), [binascii.unhexlify(sha)]):
+            return None
+        return sha
+
+    def release_changes(self, old=None, new=None):
+        """Returns the ReleaseManifest between the releases old and new
+
+        old defaults to the live release of the current host (see
+        release_catalog), new to the current release commit. If old is unknown
+        all files are reported as added."""
+        if old is None and self.release_catalog:
+            old = self.live_release()
+        return self._release_manifest(old, new)
+
+    def _release_manifest(self, old, new):
+        repo = self._get_local_repo()
+        old_commit = repo.commit(self._release_sha(old)) if old is not None else None
+        return ReleaseManifest.from_commits(repo, old_commit, repo.commit(self._release_sha(new)))
+
+    def _switch_release(self, commit=None, update_to_remote=None):
         # init repo and latest commit
         release_deployment_branch = self.release_deployment_branch()
 
@@ -392,6 +1782,27 @@ class Git(BaseCommandUtil):
         if isinstance(commit, git.Commit):
             commit = commit.hexsha
 
+        if self.release_layout == 'worktree':
+            if update_to_remote:
+                raise RuntimeError('update_to_remote is not supported by the worktree layout')
+            return self._switch_release_worktree(commit)
+        if self.release_layout != 'checkout':
+            raise RuntimeError('Unknown release_layout {layout}'.format(layout=self.release_layout))
+
+        # the checkout applies the patterns (even for unchanged files)
+        self.apply_sparse_checkout()
+
+        if self.remote_assets_path is not None:
+            # linked assets are protected from the checkout, unless they change
+            self._unmark_changed_assets(commit if commit else release_deployment_branch)
+
+        if self.release_switch_mode == 'fast':
+            if update_to_remote:
+                raise RuntimeError('update_to_remote is not supported by the fast switch mode')
+            return self._switch_release_fast(commit if commit else release_deployment_branch)
+        if self.release_switch_mode != 'checkout':
+            raise RuntimeError('Unknown release_switch_mode {mode}'.format(mode=self.release_switch_mode))
+
         # checkout changes on remote
         with fab.cd(self.remote_repository_path):
             # we switch to the appropriate commit using a normal checkout, this
@@ -410,7 +1821,7 @@ class Git(BaseCommandUtil):
             # clean.
             with fab.settings(warn_only=True):
                 # may fail on initial push
-                fab.run('git reset --hard')
+                self._run('git reset --hard')
             if update_to_remote:
                 # THIS IS NOT HOW FABDEPLOIT IS INTENDED TO BE USED
                 # If we have pulled the changes (which gitdeploit does not do by
@@ -433,28 +1844,379 @@ class Git(BaseCommandUtil):
                 # IF YOU USE THIS YOU HAVE TO FETCH FIRST (SOMEWHERE ELSE)
                 # ANYWAYS AGAIN, THIS IS NOT HOW FABDEPLOIT IS INTENDED TO BE USED
                 if commit is None or commit == release_deployment_branch:
-                    head_rev = fab.run('git rev-parse HEAD')
+                    head_rev = self._run('git rev-parse HEAD')
                     # not done here, but should look like this
                     #fab.run('git fetch "%s"' % update_to_remote)
                     # switch to headless or make sure we are in headless mode
-                    fab.run('git checkout "%s"' % head_rev)
+                    self._run('git checkout "%s"' % head_rev)
                     # update branch pointer
-                    fab.run('git update-ref "refs/heads/%s" "refs/remotes/%s/%s"' % (
+                    self._run('git update-ref "refs/heads/%s" "refs/remotes/%s/%s"' % (
                         release_deployment_branch,
                         update_to_remote,
                         release_deployment_branch,
                     ))
                     # switch to updated branch
-                    fab.run('git checkout "%s"' % release_deployment_branch)
+                    self._run('git checkout "%s"' % release_deployment_branch)
             else:
                 # Using the branch should only be done in some obscure edge cases
                 # as after we switched to a branch instead of headless checkout
                 # the first "git --reset" above will apply all file changes. This
                 # is not the indented behavior. As of this for the most cases we
                 # use the release commit sha1 whenever possible. See above.
-                fab.run('git checkout "%s"' % (commit if commit else release_deployment_branch))
+                self._run('git checkout "%s"' % (commit if commit else release_deployment_branch))
             # make sure everything is clean
-            fab.run('git reset --hard')
+            self._run('git reset --hard')
+
+    def sparse_checkout_patterns(self):
+        """Returns the sparse checkout patterns for the current host, None for a full checkout
+
+        Uses remote_sparse_checkout, override this for more complex setups."""
+        patterns = self.remote_sparse_checkout
+        if isinstance(patterns, dict):
+            for key in (fab.env.host_string, fab.env.host, '*'):
+                if key in patterns:
+                    return patterns[key]
+            return None
+        return patterns
+
+    def apply_sparse_checkout(self, worktree_path=None, update=False):
+        """Writes the sparse checkout patterns of the current host into the remote repository
+
+        The next checkout (switch_release()) only checks out matching files.
+        update applies the patterns to the current checkout immediately.
+        Does nothing if the host has no patterns. Returns True if patterns
+        were written."""
+        try:
+            from shlex import quote
+        except ImportError:  # Python 2
+            from pipes import quote
+
+        patterns = self.sparse_checkout_patterns()
+        if patterns is None:
+            return False
+        if not isinstance(patterns, (list, tuple)):  # one pattern per line
+            patterns = patterns.splitlines()
+        command = (
+            'cd "{path}" && git config core.sparseCheckout true && '
+            'f="$(git rev-parse --git-path info/sparse-checkout)" && mkdir -p "$(dirname "$f")" && '
+            'printf \'%s\\n\' {patterns} > "$f"'
+        ).format(
+            path=worktree_path or self.remote_repository_path,
+            patterns=' '.join([quote(pattern) for pattern in patterns]),
+        )
+        if update:
+            command += ' && git read-tree -mu HEAD'
+        self._run(command)
+        return True
+
+    def _switch_release_fast(self, commit):
+        """Switches to commit updating only the files changed since the current HEAD
+
+        Everything happens in one remote invocation: a two tree read-tree
+        only touches the paths differing between HEAD and commit, all other
+        files are not even looked at. Afterwards HEAD gets detached at commit
+        (like git checkout <sha> does). Returns the number of changed files.
+        """
+        started = time()
+        script = (
+            'cd "{path}" || exit 1\n'
+            'new="$(git rev-parse --verify -q "{commit}^{{commit}}")" || exit 1\n'
+            'old="$(git rev-parse --verify -q HEAD)"\n'
+            'if [ -n "$old" ]; then\n'
+            '    changed="$(git diff-tree -r --no-renames --name-only "$old" "$new" | wc -l)"\n'
+            '    git read-tree --reset -u "$old" "$new" || exit 1\n'
+            'else\n'
+            '    changed="$(git ls-tree -r --name-only "$new" | wc -l)"\n'
+            '    git read-tree --reset -u "$new" || exit 1\n'
+            'fi\n'
+            'git update-ref --no-deref HEAD "$new" || exit 1\n'
+            'echo "fabdeploit-switch $changed"'
+        ).format(path=self.remote_repository_path, commit=commit)
+        output = self._run_script(script)
+        self._invalidate_paths(self.remote_repository_path)
+        if output.failed:
+            fab.abort('Switching to %s failed: %s' % (commit, output))
+        changed_files = None
+        for line in str(output).splitlines():
+            if line.startswith('fabdeploit-switch '):
+                changed_files = int(line.split()[1])
+        self.release_switch_stats = {
+            'changed_files': changed_files,
+            'duration': time() - started,
+        }
+        fab.puts('Switched to {commit}, {changed_files} changed file(s) in {duration:.2f}s'.format(
+            commit=commit,
+            **self.release_switch_stats
+        ))
+        return changed_files
+
+
+    # Offloaded assets, see remote_assets_path
+
+    def release_assets(self, commit=None):
+        """ Returns the files offloaded from commit (default: the release) as {path: (key, size)} """
+        tree = self._get_local_repo().commit(self._release_sha(commit)).tree
+        try:
+            manifest = tree / ASSET_MANIFEST_PATH
+        except KeyError:
+            return {}
+        return _parse_asset_manifest(manifest.data_stream.read())
+
+    def _asset_store_path(self):
+        return os.path.join(self._get_local_repo().git_dir, 'fabdeploit', 'assets')
+
+    def _export_assets(self, assets):
+        """Copies the contents of assets into the local store, returns their paths relative to the store
+
+        Store files are named by their key and read-only, as they get hardlinked
+        into the checkouts on the remote."""
+        import tempfile
+
+        repo = self._get_local_repo()
+        store_path = self._asset_store_path()
+        paths = []
+        for key in sorted(set([key for key, size in assets.values()])):
+            path = posixpath.join(key[:2], key[2:])
+            paths.append(path)
+            abspath = os.path.join(store_path, key[:2], key[2:])
+            if os.path.exists(abspath):
+                continue
+            if not os.path.isdir(os.path.dirname(abspath)):
+                try:
+                    os.makedirs(os.path.dirname(abspath))
+                except OSError:  # created by another process
+                    pass
+            try:
+                stream = repo.odb.stream(binascii.unhexlify(key))
+            except Exception:
+                raise RuntimeError('Contents of asset %s not available in the local repository' % key)
+            tmp_fd, tmp_path = tempfile.mkstemp(prefix='tmp_', dir=os.path.dirname(abspath))
+            try:
+                with os.fdopen(tmp_fd, 'wb') as tmp_file:
+                    while True:
+                        chunk = stream.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        tmp_file.write(chunk)
+                os.chmod(tmp_path, 0o444)
+                os.rename(tmp_path, abspath)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return paths
+
+    def push_release_assets(self, commit=None):
+        """Uploads the contents of all files offloaded from commit (default: the release)
+
+        Files already in the remote store are skipped, returns the number of
+        files in the release store. Called by push_release()."""
+        assets = self.release_assets(commit)
+        if not assets:
+            return 0
+        if self.remote_assets_path is None:
+            raise RuntimeError('Release contains offloaded assets, but no remote_assets_path specified')
+        paths = self._export_assets(assets)
+        self._upload_files(self._asset_store_path(), self.remote_assets_path, paths)
+        return len(paths)
+
+    def materialize_assets(self, path=None):
+        """Replaces the pointer files inside path by hardlinks into the remote store
+
+        path defaults to remote_repository_path. Files not checked out (sparse
+        checkout) are skipped, just as files already linked. Linked files get
+        marked skip-worktree, so git does not turn them back into pointer files
+        when resetting or checking out (see _unmark_changed_assets()). Returns
+        the number of linked files."""
+        if path is None:
+            path = self.remote_repository_path
+        script = (
+            'cd "{path}" || exit 1\n'
+            '[ -f "{manifest}" ] || {{ echo "fabdeploit-assets 0"; exit 0; }}\n'
+            'linked="$(mktemp)" || exit 1\n'
+            'trap \'rm -f "$linked"\' EXIT\n'
+            'count=0\n'
+            'while read -r key size file; do\n'
+            '    src="{store}/${{key%"${{key#??}}"}}/${{key#??}}"\n'
+            '    [ -e "$file" ] || continue\n'
+            '    if ! [ "$src" -ef "$file" ]; then\n'
+            '        [ -f "$src" ] || {{ echo "Missing asset $key ($file)"; exit 1; }}\n'
+            '        ln -f "$src" "$file" || exit 1\n'
+            '        count=$((count + 1))\n'
+            '    fi\n'
+            '    printf \'%s\\n\' "$file" >> "$linked"\n'
+            'done < "{manifest}"\n'
+            'git update-index --skip-worktree --stdin < "$linked" || exit 1\n'
+            'echo "fabdeploit-assets $count"'
+        ).format(
+            path=path,
+            manifest=ASSET_MANIFEST_PATH,
+            store=self._abs_path(self.remote_assets_path),
+        )
+        output = self._run_script(script)
+        self._invalidate_paths(path)
+        if output.failed:
+            fab.abort('Linking assets into %s failed: %s' % (path, output))
+        for line in str(output).splitlines():
+            if line.startswith('fabdeploit-assets '):
+                return int(line.split()[1])
+        return 0
+
+    def _unmark_changed_assets(self, commit, path=None):
+        """Clears skip-worktree of the linked assets changed or deleted between HEAD and commit
+
+        So the checkout replaces them by their new pointer files (or deletes
+        them), materialize_assets() links them afterwards. All other assets stay
+        untouched. Note that with sparse checkouts git recomputes all
+        skip-worktree bits on checkout, so all assets are linked again then."""
+        if path is None:
+            path = self.remote_repository_path
+        script = (
+            'cd "{path}" || exit 1\n'
+            'old="$(git rev-parse --verify -q HEAD)" || exit 0\n'
+            'new="$(git rev-parse --verify -q "{commit}^{{commit}}")" || exit 1\n'
+            '[ -f "{manifest}" ] || exit 0\n'
+            'git -c core.quotePath=false diff-tree -r --no-renames --diff-filter=DMT --name-only "$old" "$new" |\n'
+            '    awk \'NR == FNR {{ sub(/^[^ ]* [^ ]* /, ""); assets[$0] = 1; next }} ($0 in assets)\' "{manifest}" - |\n'
+            '    git update-index --no-skip-worktree --stdin'
+        ).format(path=path, commit=commit, manifest=ASSET_MANIFEST_PATH)
+        output = self._run_script(script)
+        self._invalidate_paths(path)
+        if output.failed:
+            fab.abort('Preparing assets for the switch to %s failed: %s' % (commit, output))
+
+    # Worktree layout, see release_layout
+
+    def _releases_path(self):
+        if self.remote_releases_path is None:
+            raise RuntimeError('No remote_releases_path specified (class or constructor)')
+        return self.remote_releases_path
+
+    def _current_path(self):
+        if self.remote_current_path is not None:
+            return self.remote_current_path
+        return self._path_join(posixpath.dirname(self._releases_path().rstrip('/')), 'current')
+
+    def _previous_path(self):
+        return self._current_path().rstrip('/') + '.previous'
+
+    def _release_worktree_path(self, sha):
+        return self._abs_path(self._path_join(self._releases_path(), sha))
+
+    def _release_git_dir(self):
+        """ The remote git dir, the repository may be bare (recommended) or not """
+        dotgit_path = self._path_join(self.remote_repository_path, '.git')
+        if self._exists(dotgit_path):
+            return self._abs_path(dotgit_path)
+        return self._abs_path(self.remote_repository_path)
+
+    def _release_sha(self, commit=None):
+        if commit is None:
+            commit = self.release_commit if self.release_commit is not None else self.release_deployment_branch()
+        if isinstance(commit, git.Commit):
+            return commit.hexsha
+        return self._get_local_repo().commit(commit).hexsha
+
+    def _link_target(self, path):
+        path_stat = self._stat(path)[path]
+        if path_stat.exists and not path_stat.is_link:
+            raise RuntimeError('%s exists, but is no symlink' % path)
+        return path_stat.link_target
+
+    def _swap_link(self, path, target):
+        """ Points symlink path to target atomically (rename replaces the old link) """
+        tmp_path = path.rstrip('/') + '.fabdeploit-tmp'
+        self._run('ln -sfn "%s" "%s" && mv -T "%s" "%s"' % (target, tmp_path, tmp_path, path))
+
+    def prepare_release(self, commit=None):
+        """Checks out commit (default: the release) into its own worktree
+
+        Should be done ahead of time (push_release() does this when using the
+        worktree layout), so switch_release() only needs to swap a symlink.
+        Returns the path of the worktree."""
+        sha = self._release_sha(commit)
+        worktree_path = self._release_worktree_path(sha)
+        if not self._exists(worktree_path):
+            sparse = self.sparse_checkout_patterns() is not None
+            with self._batch():
+                self._run('mkdir -p "%s"' % self._releases_path())
+                self._run('GIT_DIR="%s" git worktree add --detach %s"%s" %s' % (
+                    self._release_git_dir(),
+                    '--no-checkout ' if sparse else '',
+                    worktree_path,
+                    sha,
+                ))
+                if sparse:
+                    self.apply_sparse_checkout(worktree_path, update=True)
+        if self.remote_assets_path is not None:
+            self.materialize_assets(worktree_path)
+        return worktree_path
+
+    def _switch_release_worktree(self, commit=None):
+        """Points the current symlink to the worktree of commit
+
+        The old target is kept as previous symlink, see rollback_release(). Both
+        links are replaced using rename, so the switch is atomic and does not
+        depend on the size of the release."""
+        worktree_path = self.prepare_release(commit)
+        current_path = self._current_path()
+        old_target = self._link_target(current_path)
+        if old_target != worktree_path:
+            with self._batch():
+                if old_target:
+                    self._swap_link(self._previous_path(), old_target)
+                self._swap_link(current_path, worktree_path)
+        self.prune_releases()
+        return worktree_path
+
+    def rollback_release(self):
+        """ Points the current symlink back to the previous release (and previous to the current one) """
+        current_path = self._current_path()
+        previous_path = self._previous_path()
+        previous_target = self._link_target(previous_path)
+        if not previous_target:
+            raise RuntimeError('No previous release to roll back to (%s)' % previous_path)
+        current_target = self._link_target(current_path)
+        with self._batch():
+            self._swap_link(current_path, previous_target)
+            if current_target:
+                self._swap_link(previous_path, current_target)
+        if self.release_catalog:
+            # worktrees are named by the sha of their release
+            self._record_switch(posixpath.basename(previous_target.rstrip('/')))
+        return previous_target
+
+    def prune_releases(self, keep=None):
+        """Removes old worktrees, keeping the newest keep ones (default: release_keep_worktrees)
+
+        The current and the previous release are always kept additionally."""
+        if keep is None:
+            keep = self.release_keep_worktrees
+        protected = [
+            posixpath.basename(target.rstrip('/'))
+            for target in (self._link_target(self._current_path()), self._link_target(self._previous_path()))
+            if target
+        ]
+        releases_path = self._abs_path(self._releases_path())
+        git_dir = self._release_git_dir()
+        script = (
+            'cd "{releases_path}" || exit 1\n'
+            'n=0\n'
+            'for d in $(ls -1t); do\n'
+            '    [ -d "$d" ] || continue\n'
+            '    case "$d" in {protected}) continue ;; esac\n'
+            '    n=$((n+1))\n'
+            '    [ $n -le {keep} ] && continue\n'
+            '    GIT_DIR="{git_dir}" git worktree remove --force "{releases_path}/$d" || rm -rf "{releases_path}/$d"\n'
+            'done\n'
+            'GIT_DIR="{git_dir}" git worktree prune'
+        ).format(
+            releases_path=releases_path,
+            protected='|'.join(protected) if protected else '""',
+            keep=int(keep),
+            git_dir=git_dir,
+        )
+        self._run(script)
+        self._invalidate_paths(releases_path)
 
 
 # BACKWARDS COMPATIBILITY
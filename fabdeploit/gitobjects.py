@@ -0,0 +1,194 @@
+from __future__ import absolute_import
+from io import BytesIO
+import hashlib
+import binascii
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+
+# Streams are read in chunks of this size, so big objects never need to fit into memory
+CHUNK_SIZE = 1024 * 1024
+
+_TYPE_IDS = {
+    b'commit': 1,
+    b'tree': 2,
+    b'blob': 3,
+    b'tag': 4,
+}
+
+
+def _type_bytes(obj_type):
+    if not isinstance(obj_type, bytes):
+        obj_type = obj_type.encode('ascii')
+    return obj_type
+
+
+class LooseObjectWriter(object):
+    '''Writes objects using the object database of the repository
+
+    Every object is written as a separate loose object file.'''
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def store(self, obj_type, stream, size):
+        ''' Hashes and stores size bytes read from stream, returns the binsha '''
+        from gitdb import IStream
+
+        if size is None:
+            data = stream.read()
+            stream, size = BytesIO(data), len(data)
+        return self.repo.odb.store(IStream(_type_bytes(obj_type), size, stream)).binsha
+
+    def has_object(self, binsha):
+        ''' True if the object was written by this writer and is not yet flushed '''
+        return False
+
+    def flush(self):
+        ''' Makes all written objects available to git, returns the path written (if any) '''
+        return None
+
+    def close(self):
+        pass
+
+
+class PackObjectWriter(object):
+    '''Collects all new objects into one packfile
+
+    Objects are compressed into a temporary pack inside objects/pack/, flush()
+    finishes the pack and writes its index, so all objects get available to
+    git at once. Writing a release then creates two files instead of one file
+    per object. Objects are not readable (by git or GitPython) before flush()
+    was called. Objects written more than once are only stored once.
+
+    store() may be called from multiple threads, compression happens outside
+    of the lock, only copying the compressed data into the pack is serialized.
+    '''
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.pack_dir = os.path.join(repo.git_dir, 'objects', 'pack')
+        self.pack_path = None
+        self._file = None
+        self._entries = {}  # {binsha: (crc, offset)}
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._file is None:
+            if not os.path.isdir(self.pack_dir):
+                os.makedirs(self.pack_dir)
+            fd, self._tmp_path = tempfile.mkstemp(prefix='tmp_pack_', dir=self.pack_dir)
+            self._file = os.fdopen(fd, 'w+b')
+            self._file.write(struct.pack('>4sLL', b'PACK', 2, 0))  # count gets fixed in flush()
+        return self._file
+
+    def _compress(self, obj_type, stream, size, output):
+        ''' Writes pack object header and data to output, returns (binsha, crc) '''
+        from gitdb.fun import create_pack_object_header
+
+        obj_type = _type_bytes(obj_type)
+        sha = hashlib.sha1(obj_type + b' ' + str(size).encode('ascii') + b'\0')
+        header = create_pack_object_header(_TYPE_IDS[obj_type], size)
+        output.write(header)
+        crc = zlib.crc32(header)
+        compressor = zlib.compressobj(zlib.Z_BEST_SPEED)
+        remaining = size
+        while remaining > 0:
+            chunk = stream.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise RuntimeError('Stream ended %d bytes early' % remaining)
+            remaining -= len(chunk)
+            sha.update(chunk)
+            compressed = compressor.compress(chunk)
+            output.write(compressed)
+            crc = zlib.crc32(compressed, crc)
+        compressed = compressor.flush()
+        output.write(compressed)
+        crc = zlib.crc32(compressed, crc)
+        return sha.digest(), crc & 0xffffffff
+
+    def store(self, obj_type, stream, size):
+        ''' Hashes and stores size bytes read from stream, returns the binsha '''
+        if size is None:
+            data = stream.read()
+            stream, size = BytesIO(data), len(data)
+        buf = tempfile.SpooledTemporaryFile(max_size=8 * CHUNK_SIZE)
+        try:
+            binsha, crc = self._compress(obj_type, stream, size, buf)
+            with self._lock:
+                if binsha in self._entries:
+                    return binsha
+                pack_file = self._open()
+                offset = pack_file.tell()
+                buf.seek(0)
+                while True:
+                    chunk = buf.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    pack_file.write(chunk)
+                self._entries[binsha] = (crc, offset)
+        finally:
+            buf.close()
+        return binsha
+
+    def has_object(self, binsha):
+        ''' True if the object was written by this writer and is not yet flushed '''
+        return binsha in self._entries
+
+    def flush(self):
+        '''Finishes the pack and writes its index, returns the pack path
+
+        The writer may be used again afterwards, new objects go into a new
+        pack. Returns None if there was nothing to write.'''
+        from gitdb.pack import IndexWriter
+
+        with self._lock:
+            if self._file is None:
+                return None
+            pack_file, entries = self._file, self._entries
+            self._file, self._entries = None, {}
+            try:
+                # fix object count, then hash the whole pack
+                pack_file.seek(8)
+                pack_file.write(struct.pack('>L', len(entries)))
+                pack_file.flush()
+                pack_file.seek(0)
+                sha = hashlib.sha1()
+                while True:
+                    chunk = pack_file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                pack_sha = sha.digest()
+                pack_file.seek(0, os.SEEK_END)
+                pack_file.write(pack_sha)
+                pack_file.flush()
+                os.fsync(pack_file.fileno())
+            finally:
+                pack_file.close()
+
+            index = IndexWriter()
+            for binsha, (crc, offset) in entries.items():
+                index.append(binsha, crc, offset)
+            index_fd, index_tmp_path = tempfile.mkstemp(prefix='tmp_idx_', dir=self.pack_dir)
+            with os.fdopen(index_fd, 'wb') as index_file:
+                index.write(pack_sha, index_file.write)
+
+            # git looks for the .idx file, so the pack has to be in place first
+            name = os.path.join(self.pack_dir, 'pack-%s' % binascii.hexlify(pack_sha).decode('ascii'))
+            for tmp_path, path in ((self._tmp_path, name + '.pack'), (index_tmp_path, name + '.idx')):
+                os.chmod(tmp_path, 0o444)
+                os.rename(tmp_path, path)
+            self.pack_path = name + '.pack'
+            return self.pack_path
+
+    def close(self):
+        ''' Drops all objects not flushed yet '''
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                os.remove(self._tmp_path)
+                self._file, self._entries = None, {}
@@ -0,0 +1,255 @@
+from __future__ import absolute_import
+from io import BytesIO
+import binascii
+import git
+from .gitobjects import LooseObjectWriter
+
+
+TREE_MODE = 0o040000
+BLOB_MODE = 0o100644
+EXECUTABLE_MODE = 0o100755
+SYMLINK_MODE = 0o120000
+SUBMODULE_MODE = 0o160000
+
+
+def is_tree_mode(mode):
+    return mode & 0o170000 == TREE_MODE
+
+
+def _split_path(path):
+    return [part for part in path.strip('/').split('/') if part]
+
+
+class _TreeNode(object):
+    '''One directory inside the TreeBuilder
+
+    entries maps {name: [mode, binsha, node]}, node is only set for sub
+    trees already loaded. entries is None as long as the tree was not loaded
+    from the object database. binsha is None if the tree was changed.'''
+
+    __slots__ = ('binsha', 'entries')
+
+    def __init__(self, binsha=None):
+        self.binsha = binsha
+        self.entries = None if binsha is not None else {}
+
+
+class TreeBuilder(object):
+    '''Edits git trees in memory
+
+    Only trees which are touched by some edit are loaded from the object
+    database, and only changed trees are written back by write(). Unchanged
+    sub trees are reused by their sha, so the cost of building a new tree
+    scales with the number of edits, not with the size of the tree.
+
+    Paths are always relative to the root of the tree and use "/". New objects
+    are written using writer (see fabdeploit.gitobjects), loose objects by
+    default.
+    '''
+
+    def __init__(self, repo, tree=None, writer=None):
+        self.repo = repo
+        self.writer = writer if writer is not None else LooseObjectWriter(repo)
+        self.root = _TreeNode(tree.binsha if tree is not None else None)
+
+    def _read_tree(self, binsha):
+        from git.objects.fun import tree_entries_from_data
+
+        return tree_entries_from_data(self.repo.odb.stream(binsha).read())
+
+    def _load(self, node):
+        if node.entries is None:
+            node.entries = dict([
+                (name, [mode, binsha, None])
+                for binsha, mode, name in self._read_tree(node.binsha)
+            ])
+        return node
+
+    def _child(self, entry):
+        if entry[2] is None:
+            entry[2] = _TreeNode(entry[1])
+        return entry[2]
+
+    def _parent(self, parts, create=False):
+        ''' Returns the node containing parts[-1] (None if it does not exist) '''
+        node = self._load(self.root)
+        for name in parts[:-1]:
+            entry = node.entries.get(name)
+            if entry is None or not is_tree_mode(entry[0]):
+                if not create:
+                    return None
+                entry = node.entries[name] = [TREE_MODE, None, _TreeNode()]
+            node = self._load(self._child(entry))
+        return node
+
+    def _touch(self, parts):
+        ''' Marks all trees on the way to parts[-1] as changed '''
+        node = self.root
+        node.binsha = None
+        for name in parts[:-1]:
+            entry = node.entries[name]
+            entry[1] = None
+            node = entry[2]
+            node.binsha = None
+
+    def _entry(self, parts):
+        node = self._parent(parts)
+        if node is None:
+            return None
+        return node.entries.get(parts[-1])
+
+    def get(self, path):
+        '''Returns (mode, binsha) for path, None if it does not exist
+
+        Changed sub trees need to be written to get their sha, use mode()
+        if you only need to know what kind of object path is.'''
+        parts = _split_path(path)
+        if not parts:
+            return (TREE_MODE, self.write().binsha)
+        entry = self._entry(parts)
+        if entry is None:
+            return None
+        if entry[1] is None:
+            return (entry[0], self._write(entry[2]))
+        return (entry[0], entry[1])
+
+    def mode(self, path):
+        ''' Returns the mode of path, None if it does not exist '''
+        parts = _split_path(path)
+        if not parts:
+            return TREE_MODE
+        entry = self._entry(parts)
+        return entry[0] if entry is not None else None
+
+    def exists(self, path):
+        return self.mode(path) is not None
+
+    def is_tree(self, path):
+        mode = self.mode(path)
+        return mode is not None and is_tree_mode(mode)
+
+    def set(self, path, mode, binsha):
+        ''' Sets path to some existing object (blob, tree or submodule commit) '''
+        parts = _split_path(path)
+        if not parts:
+            raise ValueError('Cannot replace the root tree')
+        node = self._parent(parts, create=True)
+        node.entries[parts[-1]] = [mode, binsha, None]
+        self._touch(parts)
+
+    def set_mode(self, path, mode):
+        ''' Changes the mode of some blob (like EXECUTABLE_MODE) '''
+        parts = _split_path(path)
+        entry = self._entry(parts) if parts else None
+        if entry is None:
+            raise KeyError(path)
+        if is_tree_mode(entry[0]) or is_tree_mode(mode):
+            raise ValueError('Cannot change mode of trees (%s)' % path)
+        entry[0] = mode
+        self._touch(parts)
+
+    def rename(self, old_path, new_path):
+        ''' Moves old_path (file or whole sub tree) to new_path '''
+        old_parts = _split_path(old_path)
+        entry = self._entry(old_parts) if old_parts else None
+        if entry is None:
+            raise KeyError(old_path)
+        new_parts = _split_path(new_path)
+        if not new_parts:
+            raise ValueError('Cannot replace the root tree')
+        self.remove(old_path)
+        node = self._parent(new_parts, create=True)
+        node.entries[new_parts[-1]] = entry
+        self._touch(new_parts)
+
+    def iter_entries(self, path='', recursive=False):
+        '''Yields (path, mode, binsha) for all entries below path
+
+        Does not write anything, binsha is None for changed sub trees.
+        Sub trees are yielded before their contents when recursive is set.'''
+        parts = _split_path(path)
+        if parts:
+            entry = self._entry(parts)
+            if entry is None or not is_tree_mode(entry[0]):
+                return
+            node = self._child(entry)
+        else:
+            node = self.root
+        for item in self._iter_node(node, '/'.join(parts), recursive):
+            yield item
+
+    def _iter_node(self, node, prefix, recursive):
+        self._load(node)
+        for name in sorted(node.entries):
+            entry = node.entries[name]
+            entry_path = prefix + '/' + name if prefix else name
+            yield (entry_path, entry[0], entry[1])
+            if recursive and is_tree_mode(entry[0]):
+                for item in self._iter_node(self._child(entry), entry_path, recursive):
+                    yield item
+
+    def remove(self, path):
+        ''' Removes path (file or whole sub tree), returns False if it did not exist '''
+        parts = _split_path(path)
+        if not parts:
+            raise ValueError('Cannot remove the root tree')
+        node = self._parent(parts)
+        if node is None or parts[-1] not in node.entries:
+            return False
+        del node.entries[parts[-1]]
+        self._touch(parts)
+        return True
+
+    def _store(self, data):
+        return self.writer.store(git.Tree.type, BytesIO(data), len(data))
+
+    def _write(self, node, root=False):
+        ''' Writes node and all changed sub trees, returns None for empty sub trees '''
+        from git.objects.fun import tree_to_stream
+
+        if node.binsha is not None:
+            return node.binsha
+        entries = []
+        for name, entry in node.entries.items():
+            binsha = entry[1]
+            if binsha is None:
+                binsha = self._write(entry[2])
+                if binsha is None:  # git does not store empty trees
+                    continue
+                entry[1] = binsha
+            entries.append((binsha, entry[0], name))
+        if not entries and not root:
+            return None
+        # git sorts trees as if their name would end with "/"
+        entries.sort(key=lambda e: e[2] + '/' if is_tree_mode(e[1]) else e[2])
+        stream = BytesIO()
+        tree_to_stream(entries, stream.write)
+        node.binsha = self._store(stream.getvalue())
+        return node.binsha
+
+    def write(self):
+        ''' Writes all changed trees, returns the new root git.Tree '''
+        return git.Tree(self.repo, self._write(self._load(self.root), root=True), mode=TREE_MODE, path='')
+
+
+def diff_trees(repo, old_tree, new_tree):
+    '''Returns the recursive diff between two trees
+
+    List of (status, path, new_mode, new_binsha) with status being "A" (added),
+    "M" (modified), "T" (type changed) or "D" (deleted). Renames are reported
+    as delete + add. Unchanged sub trees are skipped by git, so this scales
+    with the size of the change.
+    '''
+    output = repo.git.diff_tree('-r', '-z', '--raw', '--no-renames', old_tree.hexsha, new_tree.hexsha)
+    changes = []
+    fields = output.split('\0')
+    for i in range(0, len(fields) - 1, 2):
+        meta, path = fields[i], fields[i + 1]
+        old_mode, new_mode, old_hexsha, new_hexsha, status = meta.lstrip(':').split(' ')
+        changes.append((
+            status[0],
+            path,
+            int(new_mode, 8),
+            binascii.unhexlify(new_hexsha),
+        ))
+    return changes
@@ -12,6 +12,9 @@ class Magento(BaseCommandUtil):
         if self.magento_path is None:
             raise RuntimeError('No magento_path specified (class or constructor)')
 
+    def _fact_paths(self):
+        return [self.magento_path, self.php_ini_path]
+
     def php_bin(self):
         return self._select_bin(*self.php_commands)
 
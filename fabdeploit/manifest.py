@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+from .gittree import diff_trees
+from .patterns import PathPatterns
+
+
+class ReleaseManifest(object):
+    '''Paths changed between two releases
+
+    added, modified and deleted are sorted lists of file paths (type and mode
+    changes count as modified). old_sha is None if the previous release was
+    unknown, all files of the new release are reported as added then. This way
+    every check answers "changed" if nothing is known about the previous state.
+
+    changed() accepts gitignore-style patterns (see fabdeploit.patterns), a
+    pattern matching some directory matches everything inside of it. So deploy
+    scripts might look like:
+
+    if git.release_manifest.changed('*.py', 'requirements*.txt'):
+        virtualenv.update()
+    if git.release_manifest.changed('migrations/'):
+        django.migrate()
+    '''
+
+    def __init__(self, old_sha, new_sha, added=(), modified=(), deleted=()):
+        self.old_sha = old_sha
+        self.new_sha = new_sha
+        self.added = sorted(added)
+        self.modified = sorted(modified)
+        self.deleted = sorted(deleted)
+
+    @classmethod
+    def from_commits(cls, repo, old_commit, new_commit):
+        ''' Creates the manifest using the tree diff, old_commit may be None '''
+        if old_commit is None:
+            paths = repo.git.ls_tree('-r', '-z', '--name-only', new_commit.hexsha).split('\0')
+            return cls(None, new_commit.hexsha, added=[path for path in paths if path])
+        changes = {'A': [], 'M': [], 'D': []}
+        for status, path, mode, binsha in diff_trees(repo, old_commit.tree, new_commit.tree):
+            changes['M' if status == 'T' else status].append(path)
+        return cls(
+            old_commit.hexsha,
+            new_commit.hexsha,
+            added=changes['A'],
+            modified=changes['M'],
+            deleted=changes['D'],
+        )
+
+    @property
+    def initial(self):
+        ''' True if the previous release was unknown '''
+        return self.old_sha is None
+
+    @property
+    def paths(self):
+        ''' All changed paths, sorted '''
+        return sorted(self.added + self.modified + self.deleted)
+
+    def _filter(self, paths, patterns):
+        if not patterns:
+            return list(paths)
+        path_patterns = PathPatterns(list(patterns))
+        # like git, a matching directory matches everything inside of it
+        return [path for path in paths if path_patterns.excluded_file(path)]
+
+    def changed(self, *patterns):
+        ''' Returns the changed paths matching any of the patterns (all if no pattern is given) '''
+        return self._filter(self.paths, patterns)
+
+    def added_paths(self, *patterns):
+        return self._filter(self.added, patterns)
+
+    def modified_paths(self, *patterns):
+        return self._filter(self.modified, patterns)
+
+    def deleted_paths(self, *patterns):
+        return self._filter(self.deleted, patterns)
+
+    def __len__(self):
+        return len(self.added) + len(self.modified) + len(self.deleted)
+
+    def __bool__(self):
+        return len(self) > 0
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __repr__(self):
+        return '<ReleaseManifest %s..%s: %d added, %d modified, %d deleted>' % (
+            self.old_sha[:7] if self.old_sha else '(none)',
+            self.new_sha[:7],
+            len(self.added),
+            len(self.modified),
+            len(self.deleted),
+        )
@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+import re
+
+
+def _translate(pattern):
+    ''' Translates the glob part of a gitignore pattern into a regular expression '''
+    regex = ''
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 2] == '**':
+                # "**/" matches zero or more directories, "/**" everything inside
+                at_start = i == 0 or pattern[i - 1] == '/'
+                if at_start and pattern[i + 2:i + 3] == '/':
+                    regex += '(?:.*/)?'
+                    i += 3
+                    continue
+                if at_start and i + 2 == n:
+                    regex += '.*'
+                    i += 2
+                    continue
+            regex += '[^/]*'
+            while i < n and pattern[i] == '*':
+                i += 1
+            continue
+        if c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                regex += '\\['
+            else:
+                chars = pattern[i + 1:j].replace('\\', '\\\\')
+                if chars[0] in '!^':
+                    chars = '^' + chars[1:]
+                regex += '[%s]' % chars
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+
+class PathPattern(object):
+    '''One gitignore-style pattern
+
+    Supports everything gitignore does: "!" negates, a trailing "/" only
+    matches directories, patterns containing a "/" (besides a trailing one)
+    are anchored at the root, others match the name at any level, "*", "?",
+    "[...]" and "**" work like in git.'''
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.negated = pattern.startswith('!')
+        if self.negated:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if '/' in pattern:
+            regex = _translate(pattern.lstrip('/'))
+        else:
+            regex = '(?:.*/)?' + _translate(pattern)
+        self.regex = re.compile('^%s$' % regex, re.DOTALL)
+
+    def match(self, path, is_dir=False):
+        if self.dir_only and not is_dir:
+            return False
+        return self.regex.match(path) is not None
+
+    def __repr__(self):
+        return '<PathPattern %s>' % self.pattern
+
+
+def _clean(line):
+    # like git, trailing spaces are ignored unless escaped
+    if line.endswith('\\ '):
+        return line[:-2].rstrip(' ') + ' '
+    return line.rstrip(' \r\n')
+
+
+class PathPatterns(object):
+    '''Ordered list of gitignore-style patterns
+
+    excluded() tells whether some path is excluded, the last matching pattern
+    wins (so "!" patterns may include paths again). Like in git, paths
+    inside an excluded directory cannot be included again, so excluded
+    directories can be dropped as a whole.'''
+
+    def __init__(self, patterns=()):
+        if not isinstance(patterns, (list, tuple)):
+            patterns = patterns.splitlines()
+        self.patterns = []
+        for line in patterns:
+            line = _clean(line)
+            if not line or line.startswith('#'):
+                continue
+            self.patterns.append(PathPattern(line))
+
+    def excluded(self, path, is_dir=False):
+        path = path.strip('/')
+        for pattern in reversed(self.patterns):
+            if pattern.match(path, is_dir):
+                return not pattern.negated
+        return False
+
+    def excluded_file(self, path):
+        ''' Like excluded(), but also True if some parent directory is excluded (files inside of it are, too) '''
+        parts = path.strip('/').split('/')
+        for i in range(1, len(parts)):
+            if self.excluded('/'.join(parts[:i]), is_dir=True):
+                return True
+        return self.excluded(path)
+
+    def __bool__(self):
+        return bool(self.patterns)
+    __nonzero__ = __bool__
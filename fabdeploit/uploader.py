@@ -45,6 +45,9 @@ class BaseUploader(BaseCommandUtil):
         'default_opts': '-pthrlvz',
     }
 
+    def _fact_paths(self):
+        return [remote_path for local_path, remote_path in self.upload_paths]
+
     def _ensure_path_exists(self, path):
         if not self._exists(path):
             self._run('mkdir -p "%s"' % path)
@@ -59,6 +62,7 @@ class BaseUploader(BaseCommandUtil):
         rsync_local_path = local_path.rstrip(os.sep) + os.sep
         rsync_remote_path = remote_path.rstrip(posixpath.sep) + posixpath.sep
         rsync(local_dir=rsync_local_path, remote_dir=rsync_remote_path, **kwargs)
+        self._invalidate_paths(remote_path)
 
     def upload(self, release_id):
         raise RuntimeError('Subclass should implement this')
@@ -105,22 +109,23 @@ class GitUploader(BaseUploader):
                     current_release_sha = self._run('{git_bin} rev-parse HEAD'.format(git_bin=git_bin))
                 self._run('{git_bin} checkout master'.format(git_bin=git_bin))
                 self._rsync_upload(local_path, remote_path, exclude=('.git',))
-                self._run('{git_bin} add -A'.format(git_bin=git_bin))
-                self._run('{git_bin} ls-files --deleted -z | xargs -r -0 git rm'.format(git_bin=git_bin))
-                with fab.settings(warn_only=True):
-                    self._run('{git_bin} commit --allow-empty -m {commit_message}'.format(
-                        git_bin=git_bin,
-                        commit_message=shell_quote(commit_message),
-                    ))
-                self._run('{git_bin} tag {release_id}'.format(
-                    git_bin=git_bin,
-                    release_id=shell_quote(self._release_tag(release_id)),
-                ))
-                if current_release_sha:  # rollback to previous release
-                    self._run('{git_bin} checkout {sha}'.format(
+                with self._batch():
+                    self._run('{git_bin} add -A'.format(git_bin=git_bin))
+                    self._run('{git_bin} ls-files --deleted -z | xargs -r -0 git rm'.format(git_bin=git_bin))
+                    with fab.settings(warn_only=True):
+                        self._run('{git_bin} commit --allow-empty -m {commit_message}'.format(
+                            git_bin=git_bin,
+                            commit_message=shell_quote(commit_message),
+                        ))
+                    self._run('{git_bin} tag {release_id}'.format(
                         git_bin=git_bin,
-                        sha=shell_quote(current_release_sha),
+                        release_id=shell_quote(self._release_tag(release_id)),
                     ))
+                    if current_release_sha:  # rollback to previous release
+                        self._run('{git_bin} checkout {sha}'.format(
+                            git_bin=git_bin,
+                            sha=shell_quote(current_release_sha),
+                        ))
 
     def switch_release(self, release_id):
         git_bin = self.git_bin()
@@ -148,6 +153,13 @@ class SymLinkUploader(BaseUploader):
     ln_commands = ('ln',)
     ln_args = '-s'
 
+    def _fact_paths(self):
+        paths = super(SymLinkUploader, self)._fact_paths()
+        if self.upload_storage_path:
+            paths.append(self.upload_storage_path)
+            paths.append(self._path_join(self.upload_storage_path, self.upload_storage_current_link))
+        return paths
+
     def cp_bin(self):
         return self._select_bin(*self.cp_commands)
 
@@ -175,18 +187,24 @@ class SymLinkUploader(BaseUploader):
         return self._path_join(upload_release_path, self._get_remote_upload_pathname(release_id, remote_path))
 
     def upload(self, release_id):
-        from fabric.contrib import files
         import posixpath
 
         upload_storage_path = self._abs_path(self.upload_storage_path)
-        self._ensure_path_exists(upload_storage_path)
         upload_release_path = self._get_upload_release_path(release_id)
-        self._ensure_path_exists(upload_release_path)
-
         upload_storage_current_link = self._path_join(upload_storage_path, self.upload_storage_current_link)
 
+        # fetch all paths we need to check in one go
+        self._stat(upload_storage_path, upload_release_path, upload_storage_current_link, *[
+            path
+            for local_path, remote_path in self.upload_paths
+            for path in (remote_path, self._get_remote_upload_path(release_id, remote_path))
+        ])
+
+        self._ensure_path_exists(upload_storage_path)
+        self._ensure_path_exists(upload_release_path)
+
         for local_path, remote_path in self.upload_paths:
-            if files.exists(remote_path) and not files.is_link(remote_path):
+            if self._exists(remote_path) and not self._is_link(remote_path):
                 raise RuntimeError('Remote path already exists, but is no symlink (%s)' % remote_path)
 
             remote_upload_path = self._get_remote_upload_path(release_id, remote_path)
@@ -208,21 +226,23 @@ class SymLinkUploader(BaseUploader):
     def switch_release(self, release_id):
         upload_storage_path = self._abs_path(self.upload_storage_path)
         upload_storage_current_link = self._path_join(upload_storage_path, self.upload_storage_current_link)
+        self._stat(upload_storage_current_link, *[remote_path for local_path, remote_path in self.upload_paths])
 
         # make sure all symlinks are working
-        for local_path, remote_path in self.upload_paths:
-            remote_upload_pathname = self._get_remote_upload_pathname(release_id, remote_path)
-            if self._exists(remote_path):
-                self._run('{rm_bin} {path}'.format(
-                    rm_bin=self.rm_bin(),
-                    path=shell_quote(remote_path),
+        with self._batch():
+            for local_path, remote_path in self.upload_paths:
+                remote_upload_pathname = self._get_remote_upload_pathname(release_id, remote_path)
+                if self._exists(remote_path):
+                    self._run('{rm_bin} {path}'.format(
+                        rm_bin=self.rm_bin(),
+                        path=shell_quote(remote_path),
+                    ))
+                self._run('{ln_bin} {ln_args} {current_link} {upload_path}'.format(
+                    ln_bin=self.ln_bin(),
+                    ln_args=self.ln_args,
+                    current_link=shell_quote(self._path_join(upload_storage_current_link, remote_upload_pathname)),
+                    upload_path=shell_quote(remote_path),
                 ))
-            self._run('{ln_bin} {ln_args} {current_link} {upload_path}'.format(
-                ln_bin=self.ln_bin(),
-                ln_args=self.ln_args,
-                current_link=shell_quote(self._path_join(upload_storage_current_link, remote_upload_pathname)),
-                upload_path=shell_quote(remote_path),
-            ))
 
         # switch to current release
         if self._exists(upload_storage_current_link):
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 import posixpath
+import threading
 import os
 
 
@@ -7,28 +8,193 @@ class CommandNotFoundException(Exception):
     pass
 
 
-def select_bin(*commands, **kwargs):
-    from fabric.contrib.files import exists as remote_exists
+DEFAULT_BIN_PATHS = ('/usr/bin', '/bin',)
+
+# Binary lookups are cached per host and search path for the whole fab session,
+# mapping {(host_string, path): {command: exists}}.
+_select_bin_cache = {}
+_select_bin_cache_lock = threading.Lock()
+
+
+def _probe_remote_bins(candidates):
+    """ Checks all candidates (list of paths) in one round trip, returns existing ones """
+    import fabric.api as fab
+
+    script = '; '.join([
+        'test -e "$(echo {path})" && echo {index}'.format(path=path, index=index)
+        for index, path in enumerate(candidates)
+    ] + ['true'])
+    with fab.settings(fab.hide('everything'), warn_only=True):
+        output = fab.run(script)
+    found = set()
+    for line in output.splitlines():
+        line = line.strip()
+        if line.isdigit():
+            found.add(candidates[int(line)])
+    return found
+
+
+def _select_remote_bin(commands, paths):
+    import fabric.api as fab
+
+    host = fab.env.host_string
+    with _select_bin_cache_lock:
+        missing = [
+            (path, command)
+            for path in paths
+            for command in commands
+            if command not in _select_bin_cache.get((host, path), {})
+        ]
+    if missing:
+        found = _probe_remote_bins([posixpath.join(path, command) for path, command in missing])
+        with _select_bin_cache_lock:
+            for path, command in missing:
+                path_cache = _select_bin_cache.setdefault((host, path), {})
+                path_cache[command] = posixpath.join(path, command) in found
+    with _select_bin_cache_lock:
+        for path in paths:
+            path_cache = _select_bin_cache.get((host, path), {})
+            for command in commands:
+                if path_cache.get(command):
+                    return posixpath.join(path, command)
+    return None
+
+
+def seed_select_bin(host, path, command, exists):
+    """ Stores some already known lookup result (see facts.HostFacts) """
+
+    with _select_bin_cache_lock:
+        _select_bin_cache.setdefault((host, path), {})[command] = exists
+
+
+def invalidate_select_bin(paths=None, host=None):
+    """ Forget cached binary lookups, may be limited to some paths and/or one host """
+
+    if paths is not None and not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    with _select_bin_cache_lock:
+        for cache_host, cache_path in list(_select_bin_cache.keys()):
+            if host is not None and cache_host != host:
+                continue
+            if paths is not None and cache_path not in paths:
+                continue
+            del _select_bin_cache[(cache_host, cache_path)]
+
 
+def select_bin(*commands, **kwargs):
     paths = kwargs.get('paths', None)
     remote = kwargs.get('remote', True)
     if paths is None:
-        paths = ('/usr/bin', '/bin',)
+        paths = DEFAULT_BIN_PATHS
     elif not isinstance(paths, (list, tuple)):
         paths = [paths]
-    for path in paths:
-        for command in commands:
-            if remote:
-                command_path = posixpath.join(path, command)
-                if remote_exists(command_path):
-                    return command_path
-            else:
+    if remote:
+        command_path = _select_remote_bin(commands, paths)
+        if command_path is not None:
+            return command_path
+    else:
+        for path in paths:
+            for command in commands:
                 command_path = os.path.join(path, command)
                 if os.path.exists(command_path):
                     return command_path
     raise CommandNotFoundException('Could not find suitable binary for %s' % ','.join(commands))
 
 
+# Commands changing the paths passed to them, see mutated_paths()
+MUTATING_COMMANDS = (
+    'mkdir', 'rmdir', 'rm', 'ln', 'cp', 'mv', 'touch', 'rsync', 'tar', 'unzip',
+    'virtualenv', 'virtualenv2', 'virtualenv3',
+)
+# Commands only changing their last argument (the target)
+TARGET_MUTATING_COMMANDS = ('ln', 'cp', 'rsync',)
+# Commands changing their working directory, too
+WORKING_DIR_MUTATING_COMMANDS = ('tar', 'unzip',)
+# git sub commands not changing any files (others change the working copy)
+GIT_READONLY_COMMANDS = (
+    'rev-parse', 'config', 'log', 'show', 'status', 'diff', 'diff-tree', 'ls-files',
+    'ls-tree', 'cat-file', 'describe', 'rev-list', 'for-each-ref', 'update-ref',
+    'fetch', 'count-objects', 'version', '--version',
+)
+_COMMAND_SEPARATORS = ('&&', '||', ';', '|', '&')
+
+
+def mutated_paths(command, cwd=''):
+    """ Returns the paths some shell command may change, None if unsure
+
+    Only commands from MUTATING_COMMANDS and output redirections are taken into
+    account, all non-option arguments are considered as changed paths. Relative
+    paths are joined with cwd (cd inside the command is followed). None means
+    the command could not be parsed, so everything should be considered changed.
+    """
+    import shlex
+
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        return None
+    # split trailing ";" from tokens like "foo;"
+    split_tokens = []
+    for token in tokens:
+        if len(token) > 1 and token.endswith(';'):
+            split_tokens.extend([token[:-1], ';'])
+        else:
+            split_tokens.append(token)
+
+    paths = []
+    segment = []
+
+    def join(path):
+        return posixpath.join(cwd, path) if cwd else path
+
+    def finish_segment(segment, cwd):
+        # skip leading environment variables ("GIT_DIR=... git ...")
+        while segment and not segment[0].startswith('-') and '=' in segment[0]:
+            segment = segment[1:]
+        if not segment:
+            return cwd
+        name = posixpath.basename(segment[0])
+        if name == 'cd':
+            return join(segment[1]) if len(segment) > 1 else ''
+        if name == 'git':
+            args = [arg for arg in segment[1:] if not arg.startswith('-')]
+            if not args or args[0] in GIT_READONLY_COMMANDS:
+                return cwd
+            if args[0] in ('init', 'clone'):
+                paths.extend([join(arg) for arg in args[1:] if not '://' in arg])
+            else:
+                paths.append(cwd or '.')
+        elif name in MUTATING_COMMANDS:
+            args = [join(arg) for arg in segment[1:] if not arg.startswith('-') and not '://' in arg]
+            if name in TARGET_MUTATING_COMMANDS:
+                args = args[-1:]
+            paths.extend(args)
+            if name in WORKING_DIR_MUTATING_COMMANDS:
+                paths.append(cwd or '.')
+        return cwd
+
+    redirect = False
+    for token in split_tokens:
+        if redirect:
+            paths.append(join(token))
+            redirect = False
+        elif token in _COMMAND_SEPARATORS:
+            cwd = finish_segment(segment, cwd)
+            segment = []
+        elif token.startswith('>') or token[:2] in ('1>', '2>'):
+            if '>&' in token:  # "2>&1"
+                continue
+            target = token.lstrip('12').lstrip('>')
+            if target:
+                paths.append(join(target))
+            else:
+                redirect = True
+        else:
+            segment.append(token)
+    finish_segment(segment, cwd)
+    return [path for path in paths if path != '/dev/null']
+
+
 def legacy_wrap(legacy_constructor, methodname):
     def _legacy_wrap(*args, **kwargs):
         return getattr(legacy_constructor(), methodname)(*args, **kwargs)
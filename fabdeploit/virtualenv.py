@@ -26,11 +26,17 @@ class Virtualenv(BaseCommandUtil):
         if self.virtualenv_path is None:
             raise RuntimeError('No virtualenv_path specified (class or constructor)')
 
-    def select_bin(self, *commands):
-        return self._select_bin(*commands, paths=[
+    def _fact_paths(self):
+        return [self.virtualenv_path, self.requirements_file]
+
+    def _bin_paths(self):
+        return [
             self._path_join(self._abs_path(self.virtualenv_path), 'bin'),  # UNIX
             self._path_join(self._abs_path(self.virtualenv_path), 'Scripts'),  # Windows
-        ])
+        ]
+
+    def select_bin(self, *commands):
+        return self._select_bin(*commands, paths=self._bin_paths())
 
     def python_bin(self):
         return self.select_bin(*self.python_commands)
@@ -66,6 +72,10 @@ class Virtualenv(BaseCommandUtil):
             virtualenv_bin=virtualenv_bin,
             virtualenv_path=self.virtualenv_path,
         ))
+        # the command may not be recognized as changing the path (python virtualenv.py ...)
+        self._invalidate_paths(self._abs_path(self.virtualenv_path))
+        # bin/ was (re)created, forget about binaries looked up before
+        self._invalidate_select_bin(*self._bin_paths())
 
     def install(self):
         self.update()
@@ -103,7 +113,7 @@ class VirtualenvGit(object):
     def commit(self, message=None, tag=None):
         if message is None:
             message = datetime.datetime.now().isoformat()
-        with self.virtualenv._cd(self.virtualenv._abs_path(self.virtualenv.virtualenv_path)):
+        with self.virtualenv._cd(self.virtualenv._abs_path(self.virtualenv.virtualenv_path)), self.virtualenv._batch():
             # (re) initialize
             self.virtualenv._run('git init')
             # TODO: Make sure this is done right: